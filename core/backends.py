@@ -0,0 +1,591 @@
+import ast
+import copy
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from core.constrained import CharTokenizer, constrain_text, constrained_logits_processor, get_mask_cache
+from core.stopping import make_stop
+from core.vision_cache import VisionCache
+from utils.hashing import file_sha256
+
+QWEN_MODEL_ID = "Qwen/Qwen2.5-VL-7B-Instruct"
+
+
+@dataclass
+class GenerationRequest:
+    """One conversation to be completed by a backend, plus its decoding options."""
+    messages: list
+    max_new_tokens: int = 512
+    # Structural early stop: "json" (first object closes) or "python_block" (``` closes)
+    stop: Optional[str] = None
+    # Called with each newly decoded text chunk while the request is generating
+    on_token: Optional[Callable[[str], None]] = None
+    # Independent samples to draw for this prompt (>1 requires temperature > 0)
+    num_return_sequences: int = 1
+    temperature: float = 0.0
+    # Schema-constrained decoding (see core/constrained.py), e.g. "extraction"
+    constraint: Optional[str] = None
+
+    def generation_config(self) -> dict:
+        """The decoding options that change the output (part of the response-cache key)."""
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "stop": self.stop,
+            "num_return_sequences": self.num_return_sequences,
+            "temperature": self.temperature,
+            "constraint": self.constraint,
+        }
+
+    def sampling_key(self) -> tuple:
+        """Requests can only share one generate call if they sample (and are constrained) the same way."""
+        return (self.num_return_sequences, self.temperature, self.constraint)
+
+
+@dataclass
+class Generation:
+    """The decoded output of a single request and the token counts it cost."""
+    text: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached: bool = False
+    # Time to the first generated token vs. the rest of decoding (shared by a whole batch)
+    prefill_s: float = 0.0
+    decode_s: float = 0.0
+    # Every sampled sequence when num_return_sequences > 1 (text is candidates[0])
+    candidates: List[str] = field(default_factory=list)
+
+
+def has_image(messages: list) -> bool:
+    """True if any message carries an image (i.e. this is a vision extraction call)."""
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image" for part in content):
+            return True
+    return False
+
+
+def message_text(messages: list) -> str:
+    """Concatenates all the text parts of a conversation."""
+    chunks = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            chunks.append(content)
+        elif isinstance(content, list):
+            chunks.extend(part.get("text", "") for part in content if part.get("type") == "text")
+    return "\n".join(chunks)
+
+
+class InferenceBackend:
+    """
+    Interface every model backend implements. A backend receives a batch of requests
+    and must return one Generation per request, in the same order.
+    """
+    name = "base"
+
+    @property
+    def is_loaded(self) -> bool:
+        return True
+
+    def load(self):
+        """Pays the model load cost now instead of on the first generate call."""
+
+    def generate(self, requests: List[GenerationRequest]) -> List[Generation]:
+        raise NotImplementedError
+
+    def fingerprint(self) -> str:
+        """Identifies the model behind the backend (part of the response-cache key)."""
+        return self.name
+
+    def count_tokens(self, text: str) -> int:
+        """Prompt-token cost of `text` (whitespace words unless the backend has a tokenizer)."""
+        return len(text.split())
+
+    def stats(self) -> dict:
+        """Backend-specific counters (cache hit rates etc.)."""
+        return {}
+
+
+# --- 1. HuggingFace / bitsandbytes backend (the production path) ---
+class HFQwenBackend(InferenceBackend):
+    """Qwen2.5-VL loaded in 4-bit NF4 so it fits inside a 16GB VRAM budget."""
+    name = "hf"
+
+    def __init__(self, model_id: str = QWEN_MODEL_ID, vision_cache_bytes: int = 256 * 1024 ** 2):
+        self.model_id = model_id
+        # Image hash -> (pixel tensors, vision embeddings); 0 disables the cache
+        self.vision_cache = VisionCache(vision_cache_bytes) if vision_cache_bytes > 0 else None
+        self._pending_image_keys: Optional[List[str]] = None
+        self._device_lock = threading.Lock()
+        # Weights are loaded on first use (or an explicit load()), not at construction
+        self.model = None
+        self.processor = None
+        self._load_lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.model is not None
+
+    def load(self):
+        with self._load_lock:
+            if self.model is None:
+                self._initialize_model()
+
+    def _initialize_model(self):
+        # Heavy imports live here so the stub backend works on machines without torch
+        import torch
+        from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
+
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+        )
+
+        model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+            self.model_id,
+            device_map="auto",
+            quantization_config=bnb_config
+        )
+        self.processor = self.processor or AutoProcessor.from_pretrained(self.model_id)
+        # Decoder-only models must be LEFT padded, otherwise batched rows generate after pad tokens
+        self.processor.tokenizer.padding_side = "left"
+
+        # Route the vision tower through the embedding cache. The wrapper only short-circuits
+        # while a cached batch is being generated; every other call hits the real encoder.
+        self._vision_module = getattr(model, "model", model)
+        self._encode_images = self._vision_module.get_image_features
+        self._vision_module.get_image_features = self._cached_image_features
+
+        # Publish the model last so is_loaded never reports a half-initialized backend
+        self.model = model
+
+    def fingerprint(self) -> str:
+        return f"{self.name}:{self.model_id}"
+
+    def stats(self) -> dict:
+        return {"vision_cache": self.vision_cache.stats()} if self.vision_cache else {}
+
+    def count_tokens(self, text: str) -> int:
+        # Only the processor is needed for counting, so this never forces the weights to load
+        if self.processor is None:
+            from transformers import AutoProcessor
+            with self._load_lock:
+                if self.processor is None:
+                    self.processor = AutoProcessor.from_pretrained(self.model_id)
+        return len(self.processor.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def generate(self, requests: List[GenerationRequest]) -> List[Generation]:
+        if self.model is None:
+            self.load()
+
+        # Sampling settings are per generate() call, so mixed batches are split by them
+        groups: Dict[tuple, List[int]] = {}
+        for i, request in enumerate(requests):
+            groups.setdefault(request.sampling_key(), []).append(i)
+        if len(groups) == 1:
+            return self._generate_group(requests)
+
+        generations: List[Optional[Generation]] = [None] * len(requests)
+        for indices in groups.values():
+            for i, generation in zip(indices, self._generate_group([requests[i] for i in indices])):
+                generations[i] = generation
+        return generations
+
+    def _generate_group(self, requests: List[GenerationRequest]) -> List[Generation]:
+        import torch
+
+        conversations = [request.messages for request in requests]
+        num_sequences = requests[0].num_return_sequences
+        sampling = {}
+        if requests[0].temperature > 0:
+            sampling = {"do_sample": True, "temperature": requests[0].temperature, "num_return_sequences": num_sequences}
+        else:
+            num_sequences = 1
+        if requests[0].constraint is not None:
+            # Token masks are built over the vocabulary once per process and reused by every call
+            mask_cache = get_mask_cache(requests[0].constraint, self.processor.tokenizer)
+
+        with self._device_lock:
+            image_keys = None
+            if self.vision_cache is not None and self._is_cacheable(conversations):
+                inputs, image_keys = self._prepare_cached_inputs(conversations)
+            else:
+                inputs = self._prepare_inputs(conversations)
+
+            # One generate call for the whole batch
+            max_new_tokens = max(request.max_new_tokens for request in requests)
+            streamer = _streaming_criteria(self.processor.tokenizer, requests, inputs.input_ids.shape[1], num_sequences)
+            if requests[0].constraint is not None:
+                rows = len(requests) * num_sequences
+                sampling["logits_processor"] = [
+                    constrained_logits_processor(mask_cache, [True] * rows, inputs.input_ids.shape[1])
+                ]
+            self._pending_image_keys = image_keys
+            started = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    generated_ids = self.model.generate(
+                        **inputs, max_new_tokens=max_new_tokens, stopping_criteria=[streamer], **sampling
+                    )
+            finally:
+                self._pending_image_keys = None
+            finished = time.perf_counter()
+            prefill_s = (streamer.first_token_at or finished) - started
+            decode_s = finished - started - prefill_s
+
+        # Trim prompt tokens from output (left padding means every row shares the same prompt length)
+        prompt_width = inputs.input_ids.shape[1]
+        generated_ids_trimmed = [out_ids[prompt_width:] for out_ids in generated_ids]
+
+        output_texts = self.processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+
+        pad_id = self.processor.tokenizer.pad_token_id
+        prompt_lengths = inputs.attention_mask.sum(dim=1).tolist()
+        generations = []
+        # Sampled sequences come back grouped per prompt: rows [i*k, (i+1)*k) belong to request i
+        for i, prompt_len in enumerate(prompt_lengths):
+            rows = range(i * num_sequences, (i + 1) * num_sequences)
+            texts = [output_texts[row] for row in rows]
+            generations.append(Generation(
+                text=texts[0],
+                prompt_tokens=int(prompt_len),
+                completion_tokens=sum(int((generated_ids_trimmed[row] != pad_id).sum().item()) for row in rows),
+                prefill_s=prefill_s,
+                decode_s=decode_s,
+                candidates=texts if num_sequences > 1 else [],
+            ))
+        return generations
+
+    def _prepare_inputs(self, conversations: List[list]):
+        from qwen_vl_utils import process_vision_info
+
+        # Process the chat template for every conversation in the batch
+        texts = [
+            self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            for messages in conversations
+        ]
+
+        # Handle vision components if they exist in any of the messages
+        image_inputs, video_inputs = process_vision_info(conversations)
+
+        # Pad the batch and send it to the device the model was dispatched on
+        return self.processor(
+            text=texts,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt",
+        ).to(self.model.device)
+
+    # --- Vision embedding cache ---
+    @staticmethod
+    def _is_cacheable(conversations: List[list]) -> bool:
+        """
+        Only images with a known content hash are cached: local files, or images the engine's
+        preprocessor already decoded (image_sha256). Videos and URLs take the normal path.
+        """
+        found_image = False
+        for messages in conversations:
+            for part in _content_parts(messages):
+                if part.get("type") == "video":
+                    return False
+                if part.get("type") == "image":
+                    if "image_sha256" not in part and (not isinstance(part.get("image"), str) or not os.path.isfile(part["image"])):
+                        return False
+                    found_image = True
+        return found_image
+
+    def _prepare_cached_inputs(self, conversations: List[list]):
+        import torch
+        from transformers import BatchFeature
+
+        image_pad = "<|image_pad|>"
+        merge_length = self.processor.image_processor.merge_size ** 2
+
+        texts, keys, entries = [], [], []
+        for messages in conversations:
+            text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            for part in _content_parts(messages):
+                if part.get("type") != "image":
+                    continue
+                key, entry = self._vision_entry(part)
+                keys.append(key)
+                entries.append(entry)
+                # Expand this image's single placeholder to its visual token count, like the processor does
+                num_tokens = int(entry["image_grid_thw"].prod()) // merge_length
+                text = text.replace(image_pad, "<|placeholder|>" * num_tokens, 1)
+            texts.append(text.replace("<|placeholder|>", image_pad))
+
+        inputs = self.processor.tokenizer(texts, padding=True, return_tensors="pt")
+        inputs = BatchFeature(data={
+            **inputs,
+            "pixel_values": torch.cat([entry["pixel_values"] for entry in entries], dim=0),
+            "image_grid_thw": torch.cat([entry["image_grid_thw"] for entry in entries], dim=0),
+        })
+        return inputs.to(self.model.device), keys
+
+    def _vision_entry(self, image_part: dict):
+        """Returns (key, entry) for one image, decoding and encoding it only on a cache miss."""
+        import torch
+        from qwen_vl_utils import process_vision_info
+
+        # Resize options such as max_pixels change the tensors, so they are part of the key
+        options = sorted((k, str(v)) for k, v in image_part.items() if k not in ("type", "image", "image_sha256"))
+        image_hash = image_part.get("image_sha256") or file_sha256(image_part["image"])
+        key = f"{image_hash}:{options}"
+
+        entry = self.vision_cache.get(key)
+        if entry is not None:
+            return key, entry
+
+        image_inputs, _ = process_vision_info([{"role": "user", "content": [image_part]}])
+        processed = self.processor.image_processor(images=image_inputs, return_tensors="pt")
+        pixel_values = processed["pixel_values"].to(self.model.device)
+        image_grid_thw = processed["image_grid_thw"].to(self.model.device)
+        with torch.no_grad():
+            image_features = self._encode_images(pixel_values, image_grid_thw)
+
+        entry = {"pixel_values": pixel_values, "image_grid_thw": image_grid_thw, "image_features": image_features}
+        self.vision_cache.put(key, entry)
+        return key, entry
+
+    def _cached_image_features(self, pixel_values, image_grid_thw=None, *args, **kwargs):
+        keys = self._pending_image_keys
+        if not keys:
+            return self._encode_images(pixel_values, image_grid_thw, *args, **kwargs)
+        # The prefill step asks for every image in the batch at once; answer from the cache
+        entries = []
+        for key in keys:
+            entry = self.vision_cache.get(key)
+            if entry is None:
+                # Evicted mid-batch (tiny budget): encode the whole batch for real
+                return self._encode_images(pixel_values, image_grid_thw, *args, **kwargs)
+            entries.append(entry)
+        return _concat_image_features([entry["image_features"] for entry in entries])
+
+
+def _streaming_criteria(tokenizer, requests: List[GenerationRequest], prompt_length: int, num_sequences: int = 1):
+    """
+    Stopping criterion run after every decode step. It timestamps the first step (end of
+    prefill), streams each row's newly decoded text to its on_token callback, and marks a
+    row finished as soon as its structural stop (balanced JSON / closed code fence) fires.
+    With several sequences per prompt, only a prompt's first sample is streamed.
+    """
+    import torch
+    from transformers import StoppingCriteria
+
+    class StreamingStopper(StoppingCriteria):
+        def __init__(self):
+            self.first_token_at = None
+            self.rows = [(request, n == 0) for request in requests for n in range(num_sequences)]
+            self.stops = [make_stop(request.stop) for request, _ in self.rows]
+            self.texts = ["" for _ in self.rows]
+            self.done = [False for _ in self.rows]
+
+        def __call__(self, input_ids, scores, **kwargs):
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+
+            for row, (request, streamed) in enumerate(self.rows):
+                on_token = request.on_token if streamed else None
+                if self.done[row] or (self.stops[row] is None and on_token is None):
+                    continue
+                # Re-decode the row's whole completion so multi-token characters come out right
+                text = tokenizer.decode(input_ids[row, prompt_length:], skip_special_tokens=True)
+                if text.endswith("\ufffd"):
+                    continue  # Half of a multi-byte character; wait for the next token
+                chunk = text[len(self.texts[row]):]
+                self.texts[row] = text
+                if not chunk:
+                    continue
+                if on_token is not None:
+                    on_token(chunk)
+                if self.stops[row] is not None and self.stops[row].feed(chunk):
+                    self.done[row] = True
+
+            return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+    return StreamingStopper()
+
+
+def _content_parts(messages: list) -> list:
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts.extend(content)
+    return parts
+
+
+def _visual_tokens(messages: list) -> int:
+    """Visual tokens the preprocessed images in `messages` would cost (28x28 pixels each)."""
+    return sum(
+        (part["resized_width"] // 28) * (part["resized_height"] // 28)
+        for part in _content_parts(messages)
+        if part.get("type") == "image" and "resized_width" in part and "resized_height" in part
+    )
+
+
+def _concat_image_features(features: list):
+    """Joins per-image get_image_features outputs into the shape a batched call returns."""
+    import torch
+
+    first = features[0]
+    if isinstance(first, (list, tuple)):
+        return type(first)(chunk for feature in features for chunk in feature)
+    if hasattr(first, "pooler_output"):
+        # Newer transformers wrap the per-image embeddings in a ModelOutput
+        merged = copy.copy(first)
+        merged.pooler_output = _concat_image_features([feature.pooler_output for feature in features])
+        return merged
+    return torch.cat(features, dim=0)
+
+
+# --- 2. Deterministic CPU stub (CI, load tests, orchestration benchmarks) ---
+class StubBackend(InferenceBackend):
+    """
+    Returns scripted responses instantly (or after a simulated latency) so the whole graph
+    can be exercised without a GPU. By default it answers extraction calls with a JSON
+    object built from the query and coding calls with a script that prints the first value.
+
+    `script` may be a callable(messages) -> str, or a dict with "extract" and "code" lists
+    that are replayed in order (cycling) for each kind of call.
+    """
+    name = "stub"
+
+    def __init__(
+        self,
+        script: Union[None, Callable[[list], str], Dict[str, List[str]]] = None,
+        latency_s: float = 0.0,
+        per_item_latency_s: float = 0.0,
+    ):
+        self.script = script
+        # Simulated cost of one batched call: a fixed launch cost plus a per-row cost
+        self.latency_s = latency_s
+        self.per_item_latency_s = per_item_latency_s
+        self._cursor = {"extract": 0, "code": 0}
+        self.calls = 0
+        self.tokenizer = CharTokenizer()
+        # Like the real singleton model, the simulated device runs one batch at a time
+        self._device_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "StubBackend":
+        script = None
+        script_path = os.getenv("AGENT_STUB_SCRIPT")
+        if script_path:
+            with open(script_path, "r") as f:
+                script = json.load(f)
+        return cls(
+            script=script,
+            latency_s=float(os.getenv("AGENT_STUB_LATENCY_MS", "0")) / 1000,
+            per_item_latency_s=float(os.getenv("AGENT_STUB_PER_ITEM_MS", "0")) / 1000,
+        )
+
+    def generate(self, requests: List[GenerationRequest]) -> List[Generation]:
+        with self._device_lock:
+            self.calls += 1
+            delay = self.latency_s + self.per_item_latency_s * len(requests)
+            if delay > 0:
+                time.sleep(delay)
+
+            generations = []
+            for request in requests:
+                # Each sample consumes the next scripted response, so scripts can mix good and bad candidates
+                texts = [self._respond(request.messages) for _ in range(max(request.num_return_sequences, 1))]
+                if request.constraint is not None:
+                    # Same automaton and masks as the HF path, over a small character tokenizer
+                    mask_cache = get_mask_cache(request.constraint, self.tokenizer)
+                    texts = [constrain_text(mask_cache, text) for text in texts]
+                texts[0] = self._stream(request, texts[0])
+                texts[1:] = [self._stream(GenerationRequest(request.messages, stop=request.stop), t) for t in texts[1:]]
+                generations.append(Generation(
+                    text=texts[0],
+                    prompt_tokens=len(message_text(request.messages).split()) + _visual_tokens(request.messages),
+                    completion_tokens=sum(len(text.split()) for text in texts),
+                    # The fixed cost stands in for prefill, the per-row cost for decoding
+                    prefill_s=self.latency_s,
+                    decode_s=self.per_item_latency_s * len(requests),
+                    candidates=texts if len(texts) > 1 else [],
+                ))
+            return generations
+
+    @staticmethod
+    def _stream(request: GenerationRequest, text: str) -> str:
+        """Replays the scripted text word by word through on_token and the structural stop."""
+        stop = make_stop(request.stop)
+        if stop is None and request.on_token is None:
+            return text
+        emitted = ""
+        for chunk in re.findall(r"\s*\S+|\s+$", text):
+            emitted += chunk
+            if request.on_token is not None:
+                request.on_token(chunk)
+            if stop is not None and stop.feed(chunk):
+                break
+        return emitted
+
+    def _respond(self, messages: list) -> str:
+        kind = "extract" if has_image(messages) else "code"
+
+        if callable(self.script):
+            return self.script(messages)
+        if isinstance(self.script, dict) and self.script.get(kind):
+            responses = self.script[kind]
+            text = responses[self._cursor[kind] % len(responses)]
+            self._cursor[kind] += 1
+            return text
+
+        if kind == "extract":
+            return self._default_extraction(message_text(messages))
+        return self._default_code(message_text(messages))
+
+    @staticmethod
+    def _default_extraction(prompt: str) -> str:
+        # Derive stable labels/values from the query so repeated runs are byte-identical
+        query_match = re.search(r'query: "(.*?)"', prompt, re.DOTALL)
+        query = query_match.group(1) if query_match else prompt
+        labels = re.findall(r"\b(?:19|20)\d{2}\b", query) or ["Value_1", "Value_2"]
+        data = {label: (sum(map(ord, label)) % 97) + 1 for label in labels}
+        payload = {"reasoning": "Stub backend: values derived deterministically from the query.", "extracted_data": data}
+        return "```json\n" + json.dumps(payload) + "\n```"
+
+    @staticmethod
+    def _default_code(prompt: str) -> str:
+        data: Dict[str, Any] = {}
+        data_match = re.search(r"Data: (\{.*?\})\n", prompt, re.DOTALL)
+        if data_match:
+            try:
+                data = ast.literal_eval(data_match.group(1))
+            except (ValueError, SyntaxError):
+                data = {}
+        return (
+            "```python\n"
+            f"data = {data!r}\n"
+            "values = [v for v in data.get('extracted_data', data).values() if isinstance(v, (int, float))]\n"
+            "answer = values[0] if values else None\n"
+            "print(f\"SUCCESS: {answer}\")\n"
+            "```"
+        )
+
+
+def create_backend(name: Optional[str] = None) -> InferenceBackend:
+    """Builds the backend selected by name or by the AGENT_BACKEND env var (default: hf)."""
+    name = (name or os.getenv("AGENT_BACKEND", "hf")).lower()
+    if name == "hf":
+        return HFQwenBackend(
+            os.getenv("AGENT_MODEL_ID", QWEN_MODEL_ID),
+            vision_cache_bytes=int(float(os.getenv("AGENT_VISION_CACHE_MB", "256")) * 1024 ** 2),
+        )
+    if name == "stub":
+        return StubBackend.from_env()
+    raise ValueError(f"Unknown inference backend '{name}'. Expected 'hf' or 'stub'.")
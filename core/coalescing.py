@@ -0,0 +1,158 @@
+"""
+Request coalescing and a final-answer cache in front of the graph.
+
+Jobs are keyed by the image's content hash plus the normalized query, so the same chart
+uploaded twice under different names is still the same job. While a job runs, identical
+jobs attach to it as followers and receive its events instead of starting their own graph
+run; once it finishes with an answer, the result is kept in a TTL/LRU cache.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+from utils.hashing import bytes_sha256, file_sha256
+from utils.packed import is_packed_uri, packed_image_sha256
+
+# Marks the end of a run's event stream
+CLOSED = object()
+
+
+def normalize_query(query: str) -> str:
+    """Case, runs of whitespace and trailing punctuation don't change what is being asked."""
+    return re.sub(r"\s+", " ", query).strip().lower().rstrip("?.! ")
+
+
+def job_key(image_path: str, query: str) -> str:
+    image_hash = packed_image_sha256(image_path) if is_packed_uri(image_path) else file_sha256(image_path)
+    return bytes_sha256(f"{image_hash}\n{normalize_query(query)}".encode("utf-8"))
+
+
+class AnswerCache:
+    """Completed job results, bounded by entry count and expired after `ttl_s` seconds."""
+
+    def __init__(self, max_entries: int = 1024, ttl_s: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.expired = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            stored_at, result = item
+            if time.monotonic() - stored_at > self.ttl_s:
+                del self._entries[key]
+                self.expired += 1
+                return None
+            self._entries.move_to_end(key)
+            return result
+
+    def put(self, key: str, result: dict):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "ttl_s": self.ttl_s, "expired": self.expired}
+
+
+class InflightRun:
+    """
+    The event stream of one executing job. Subscribers get every event published so far
+    (replayed) and then each new one, ending with CLOSED.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.events: List[object] = []
+        self._subscribers: List[Callable[[object], None]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: Callable[[object], None]):
+        with self._lock:
+            for event in self.events:
+                callback(event)
+            self._subscribers.append(callback)
+
+    def publish(self, event):
+        with self._lock:
+            self.events.append(event)
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(event)
+
+
+class JobCoalescer:
+    """Decides, per job, whether to serve it from cache, attach it to a running twin, or run it."""
+
+    def __init__(self, cache: Optional[AnswerCache] = None):
+        self.cache = cache
+        self._inflight: dict = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.executions = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["JobCoalescer"]:
+        """AGENT_COALESCE=0 disables; AGENT_ANSWER_CACHE_TTL_S=0 keeps coalescing but caches nothing."""
+        if os.getenv("AGENT_COALESCE", "1") == "0":
+            return None
+        ttl_s = float(os.getenv("AGENT_ANSWER_CACHE_TTL_S", "300"))
+        cache = AnswerCache(int(os.getenv("AGENT_ANSWER_CACHE_SIZE", "1024")), ttl_s) if ttl_s > 0 else None
+        return cls(cache)
+
+    def acquire(self, key: str) -> Tuple[str, object]:
+        """
+        ("cached", result) for a fresh cached answer, ("coalesced", run) to follow a
+        running twin, or ("leader", run): the caller must execute the job, publish its
+        events to `run` and then call complete().
+        """
+        with self._lock:
+            self.requests += 1
+            result = self.cache.get(key) if self.cache is not None else None
+            if result is not None:
+                self.cache_hits += 1
+                return "cached", result
+            run = self._inflight.get(key)
+            if run is not None:
+                self.coalesced += 1
+                return "coalesced", run
+            run = self._inflight[key] = InflightRun(key)
+            self.executions += 1
+            return "leader", run
+
+    def complete(self, run: InflightRun, result: Optional[dict]):
+        """Detaches the run (new twins now start fresh), caches an answered result, closes the stream."""
+        with self._lock:
+            if self._inflight.get(run.key) is run:
+                del self._inflight[run.key]
+            if self.cache is not None and result and result.get("final_answer"):
+                self.cache.put(run.key, result)
+        run.publish(CLOSED)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "requests": self.requests,
+                "executions": self.executions,
+                "cache_hits": self.cache_hits,
+                "coalesced": self.coalesced,
+                "cache_hit_rate": (self.cache_hits / self.requests) if self.requests else 0.0,
+                "coalesced_rate": (self.coalesced / self.requests) if self.requests else 0.0,
+                "inflight": len(self._inflight),
+            }
+        if self.cache is not None:
+            stats["answer_cache"] = self.cache.stats()
+        return stats
@@ -0,0 +1,402 @@
+"""
+Schema-constrained decoding for the extractor.
+
+A character-level pushdown automaton accepts exactly the valid prefixes of
+    {"reasoning": "<string>", "extracted_data": {<any JSON object>}}
+(whitespace allowed between tokens). To turn it into a token mask, the vocabulary is
+decoded once into a character trie; the allowed token ids for an automaton state are
+found by walking the trie with the automaton, and memoized per state. Generation
+revisits the same few states (inside a string, after a value, ...), so after the first
+steps masking is a dict lookup plus one tensor fill.
+"""
+import threading
+from collections import OrderedDict, deque
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+MAX_DEPTH = 8            # nesting allowed inside extracted_data
+MASK_CACHE_STATES = 4096  # memoized automaton states per vocabulary
+_WHITESPACE = " \t\n\r"
+_OPAQUE = "\ufffd"       # a token holding part of a multi-byte character (only valid inside strings)
+
+# The extractor schema: fixed literals with typed holes, whitespace allowed between items
+EXTRACTION_TEMPLATE = (
+    ("lit", "{"),
+    ("lit", '"reasoning"'),
+    ("lit", ":"),
+    ("hole", '"'),      # a string
+    ("lit", ","),
+    ("lit", '"extracted_data"'),
+    ("lit", ":"),
+    ("hole", "{"),      # an object
+    ("lit", "}"),
+)
+SCHEMAS = {"extraction": EXTRACTION_TEMPLATE}
+
+
+# --- 1. Generic JSON value automaton (immutable, hashable states) ---
+# A state is (mode, stack, aux): stack holds "O"/"A" for open objects/arrays.
+def _value_done(stack: tuple):
+    return ("done", (), None) if not stack else ("after", stack, None)
+
+
+def _start_value(char: str, stack: tuple):
+    if char == '"':
+        return ("str", stack, "v")
+    if char in "{[":
+        if len(stack) >= MAX_DEPTH:
+            return None
+        return ("key_or_end", stack + ("O",), None) if char == "{" else ("value_or_end", stack + ("A",), None)
+    if char == "-":
+        return ("sign", stack, None)
+    if char == "0":
+        return ("zero", stack, None)
+    if char.isdigit():
+        return ("int", stack, None)
+    for literal in ("true", "false", "null"):
+        if char == literal[0]:
+            return ("lit", stack, literal[1:])
+    return None
+
+
+def _end_number(char: str, stack: tuple):
+    # A number only ends at the next structural character, which is then consumed as usual
+    return _json_step(("after", stack, None), char)
+
+
+@lru_cache(maxsize=65536)
+def _json_step(state: tuple, char: str):
+    mode, stack, aux = state
+
+    if mode in ("str", "esc", "uni"):
+        if mode == "esc":
+            if char in '"\\/bfnrt':
+                return ("str", stack, aux)
+            return ("uni", stack, (aux, 4)) if char == "u" else None
+        if mode == "uni":
+            if char not in "0123456789abcdefABCDEF":
+                return None
+            kind, left = aux
+            return ("str", stack, kind) if left == 1 else ("uni", stack, (kind, left - 1))
+        if char == "\\":
+            return ("esc", stack, aux)
+        if char == '"':
+            return ("colon", stack, None) if aux == "k" else _value_done(stack)
+        return None if ord(char) < 0x20 else state
+
+    if mode in ("sign", "zero", "int", "frac0", "frac", "exp0", "exp_sign", "exp"):
+        if mode == "sign":
+            return ("zero", stack, None) if char == "0" else ("int", stack, None) if char.isdigit() else None
+        if mode in ("frac0", "exp0", "exp_sign"):
+            if char.isdigit():
+                return ("frac" if mode == "frac0" else "exp", stack, None)
+            return ("exp_sign", stack, None) if mode == "exp0" and char in "+-" else None
+        if char.isdigit() and mode != "zero":
+            return state
+        if char == "." and mode in ("zero", "int"):
+            return ("frac0", stack, None)
+        if char in "eE" and mode in ("zero", "int", "frac"):
+            return ("exp0", stack, None)
+        return _end_number(char, stack)
+
+    if mode == "lit":
+        if char != aux[0]:
+            return None
+        return _value_done(stack) if len(aux) == 1 else ("lit", stack, aux[1:])
+
+    if char in _WHITESPACE:
+        return state if mode != "done" else None
+
+    if mode == "value":
+        if aux is not None and char not in aux:
+            return None
+        return _start_value(char, stack)
+    if mode == "value_or_end":
+        if char == "]":
+            return _value_done(stack[:-1])
+        return _start_value(char, stack)
+    if mode in ("key_or_end", "key"):
+        if char == '"':
+            return ("str", stack, "k")
+        if char == "}" and mode == "key_or_end":
+            return _value_done(stack[:-1])
+        return None
+    if mode == "colon":
+        return ("value", stack, None) if char == ":" else None
+    if mode == "after":
+        if char == ",":
+            return ("key", stack, None) if stack[-1] == "O" else ("value", stack, None)
+        if (char == "}" and stack[-1] == "O") or (char == "]" and stack[-1] == "A"):
+            return _value_done(stack[:-1])
+        return None
+    return None
+
+
+# --- 2. Schema template automaton ---
+class SchemaAutomaton:
+    """
+    Steps through a template of literals and typed JSON holes. States are hashable:
+    (item_index, literal_offset_or_json_state); item_index == len(template) means complete.
+    """
+
+    def __init__(self, template: Sequence[tuple] = EXTRACTION_TEMPLATE):
+        self.template = tuple(template)
+        self.initial = self._enter(0)
+        self._step = lru_cache(maxsize=65536)(self._step_uncached)
+
+    def _enter(self, index: int):
+        if index < len(self.template) and self.template[index][0] == "hole":
+            return (index, ("value", (), self.template[index][1]))
+        return (index, 0)
+
+    def is_complete(self, state) -> bool:
+        return state[0] == len(self.template)
+
+    def step(self, state, char: str):
+        """The state after `char`, or None if `char` cannot extend a valid prefix."""
+        return self._step(state, char)
+
+    def _step_uncached(self, state, char: str):
+        index, inner = state
+        if index == len(self.template):
+            return None
+        kind, value = self.template[index]
+        if kind == "lit":
+            if inner == 0 and char in _WHITESPACE:
+                return state
+            if char != value[inner]:
+                return None
+            return self._enter(index + 1) if inner + 1 == len(value) else (index, inner + 1)
+
+        if char == _OPAQUE:
+            # Partial multi-byte characters can only appear inside string contents
+            return state if inner[0] == "str" else None
+        after = _json_step(inner, char)
+        if after is None:
+            return None
+        return self._enter(index + 1) if after[0] == "done" else (index, after)
+
+    def feed(self, state, text: str):
+        for char in text:
+            state = self.step(state, char)
+            if state is None:
+                return None
+        return state
+
+    def shortest_completion(self, state, alphabet: Optional[str] = None, max_length: int = 256) -> Optional[str]:
+        """Fewest characters that turn `state` into a complete document (BFS)."""
+        if alphabet is None:
+            literal_chars = "".join(value for kind, value in self.template if kind == "lit")
+            alphabet = "".join(sorted(set(literal_chars + '"}]0')))
+        queue = deque([(state, "")])
+        seen = {state}
+        while queue:
+            current, text = queue.popleft()
+            if self.is_complete(current):
+                return text
+            if len(text) >= max_length:
+                continue
+            for char in alphabet:
+                following = self.step(current, char)
+                if following is not None and following not in seen:
+                    seen.add(following)
+                    queue.append((following, text + char))
+        return None
+
+
+# --- 3. Token masks over a vocabulary ---
+class TokenMaskCache:
+    """
+    Allowed-token sets for a vocabulary under a SchemaAutomaton. The vocabulary is turned
+    into a character trie once; masks are memoized per automaton state (LRU).
+    """
+
+    def __init__(self, vocab: Dict[int, str], eos_token_ids: Iterable[int], automaton: SchemaAutomaton):
+        self.vocab = vocab
+        self.eos_token_ids = sorted(set(eos_token_ids))
+        self.automaton = automaton
+        self._trie = self._build_trie(vocab)
+        self._masks: "OrderedDict[tuple, List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _build_trie(vocab: Dict[int, str]) -> dict:
+        # node = {char: child, ..., None: [token ids ending here]}
+        root: dict = {}
+        for token_id, text in vocab.items():
+            if not text:
+                continue
+            node = root
+            for char in text:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(token_id)
+        return root
+
+    def allowed(self, state) -> List[int]:
+        """Token ids that keep the output a valid prefix (only EOS once it is complete)."""
+        with self._lock:
+            cached = self._masks.get(state)
+            if cached is not None:
+                self._masks.move_to_end(state)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        if self.automaton.is_complete(state):
+            allowed = list(self.eos_token_ids)
+        else:
+            allowed = []
+            stack = [(self._trie, state)]
+            while stack:
+                node, current = stack.pop()
+                for char, child in node.items():
+                    if char is None:
+                        continue
+                    following = self.automaton.step(current, char)
+                    if following is None:
+                        continue
+                    allowed.extend(child.get(None, ()))
+                    stack.append((child, following))
+            allowed.sort()
+
+        with self._lock:
+            self._masks[state] = allowed
+            if len(self._masks) > MASK_CACHE_STATES:
+                self._masks.popitem(last=False)
+        return allowed
+
+    def advance(self, state, token_id: int):
+        """Automaton state after emitting `token_id` (EOS leaves a complete state unchanged)."""
+        if token_id in self.eos_token_ids:
+            return state
+        return self.automaton.feed(state, self.vocab.get(token_id, ""))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"states": len(self._masks), "hits": self.hits, "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0}
+
+
+def tokenizer_vocab(tokenizer) -> Tuple[Dict[int, str], List[int]]:
+    """Decoded text of every regular token, plus the ids that end generation."""
+    special = set(tokenizer.all_special_ids)
+    vocab = {}
+    for token_id in range(len(tokenizer)):
+        if token_id in special:
+            continue
+        text = tokenizer.decode([token_id], skip_special_tokens=False, clean_up_tokenization_spaces=False)
+        # Byte-level BPE pieces of a multi-byte character decode to U+FFFD
+        vocab[token_id] = _OPAQUE if _OPAQUE in text else text
+    eos = tokenizer.eos_token_id
+    eos_ids = [eos] if isinstance(eos, int) else list(eos or [])
+    if tokenizer.pad_token_id is not None:
+        eos_ids.append(tokenizer.pad_token_id)
+    return vocab, eos_ids
+
+
+_mask_caches: Dict[tuple, TokenMaskCache] = {}
+_mask_caches_lock = threading.Lock()
+
+
+def get_mask_cache(schema: str, tokenizer) -> TokenMaskCache:
+    """One TokenMaskCache per (schema, tokenizer), built on first use and kept for the process."""
+    if schema not in SCHEMAS:
+        raise ValueError(f"Unknown constraint '{schema}'. Expected one of {sorted(SCHEMAS)}.")
+    key = (schema, getattr(tokenizer, "name_or_path", id(tokenizer)), len(tokenizer))
+    with _mask_caches_lock:
+        cache = _mask_caches.get(key)
+        if cache is None:
+            vocab, eos_ids = tokenizer_vocab(tokenizer)
+            cache = TokenMaskCache(vocab, eos_ids, SchemaAutomaton(SCHEMAS[schema]))
+            _mask_caches[key] = cache
+        return cache
+
+
+def constrained_logits_processor(mask_cache: TokenMaskCache, constrained_rows: List[bool], prompt_length: int):
+    """
+    A transformers LogitsProcessor that masks every token that would break the schema.
+    Rows whose entry in `constrained_rows` is False (other requests in the batch) are untouched.
+    """
+    import torch
+    from transformers import LogitsProcessor
+
+    class SchemaLogitsProcessor(LogitsProcessor):
+        def __init__(self):
+            self.states = [mask_cache.automaton.initial if c else None for c in constrained_rows]
+            self.seen = prompt_length
+
+        def __call__(self, input_ids, scores):
+            # Advance each row's automaton by the token chosen at the previous step
+            if input_ids.shape[1] > self.seen:
+                last = input_ids[:, -1].tolist()
+                for row, state in enumerate(self.states):
+                    if state is not None:
+                        following = mask_cache.advance(state, last[row])
+                        # Unreachable with the mask applied; keep the row usable if it happens
+                        self.states[row] = following if following is not None else state
+                self.seen = input_ids.shape[1]
+
+            for row, state in enumerate(self.states):
+                if state is None:
+                    continue
+                allowed = mask_cache.allowed(state)
+                mask = torch.full_like(scores[row], float("-inf"))
+                if allowed:
+                    mask[torch.tensor(allowed, device=scores.device)] = 0
+                scores[row] = scores[row] + mask
+            return scores
+
+    return SchemaLogitsProcessor()
+
+
+class CharTokenizer:
+    """
+    A tiny tokenizer (printable ASCII characters plus a few multi-character JSON pieces)
+    with just the interface tokenizer_vocab() needs. Lets the stub backend and quick checks
+    run the real mask machinery without downloading a model tokenizer.
+    """
+    name_or_path = "char-tokenizer"
+    _pieces = ['{"', '": ', '", "', '"}', '"reasoning"', '"extracted_data"', "  ", "\n"]
+
+    def __init__(self):
+        self._tokens = [chr(code) for code in range(32, 127)] + self._pieces
+        self.eos_token_id = len(self._tokens)
+        self.pad_token_id = None
+        self.all_special_ids = [self.eos_token_id]
+
+    def __len__(self):
+        return len(self._tokens) + 1
+
+    def decode(self, token_ids, **kwargs) -> str:
+        return "".join(self._tokens[i] for i in token_ids if i < len(self._tokens))
+
+
+def constrain_text(mask_cache: TokenMaskCache, text: str) -> str:
+    """
+    Greedy constrained decoding against a fixed "preferred" text, as the stub backend does:
+    at each step emit the longest allowed token that continues the text, skip characters
+    the mask rules out (fences, filler), and close the document once the text runs out.
+    """
+    automaton = mask_cache.automaton
+    state, position, output = automaton.initial, 0, []
+    while not automaton.is_complete(state) and position < len(text):
+        allowed = set(mask_cache.allowed(state))
+        node, best, depth = mask_cache._trie, None, 0
+        while position + depth < len(text) and text[position + depth] in node:
+            node = node[text[position + depth]]
+            depth += 1
+            candidates = [token_id for token_id in node.get(None, ()) if token_id in allowed]
+            if candidates:
+                best = (candidates[0], depth)
+        if best is None:
+            position += 1  # The model would have put its mass on an allowed token instead
+            continue
+        token_id, length = best
+        output.append(mask_cache.vocab[token_id])
+        state = mask_cache.advance(state, token_id)
+        position += length
+    if not automaton.is_complete(state):
+        output.append(automaton.shortest_completion(state) or "")
+    return "".join(output)
@@ -1,7 +1,8 @@
 from langgraph.graph import StateGraph, END
 from core.state import AgentState
+from core.tracing import traced_node
 from nodes.coder import write_code_node
-from nodes.executor import execute_code_node
+from nodes.executor import CODE_ONLY_FAILURES, execute_code_node
 from nodes.extractor import extract_data_node
 
 # --- 1. Routing Logic (The "Self-Correction" Brain) ---
@@ -21,6 +22,12 @@ def verification_router(state: AgentState) -> str:
         print("Max retries reached. Forcing exit.")
         return "max_retries"
     
+    # A crash or timeout with valid extracted data is a code bug: only regenerate the script,
+    # skipping another (expensive) multimodal prefill over the image
+    extracted = state.get("extracted_data") or {}
+    if state.get("failure_type") in CODE_ONLY_FAILURES and extracted and "extraction_error" not in extracted:
+        return "retry_code"
+
     # Otherwise, it failed. We route back to the Vision Extractor to look at the image again.
     return "retry"
 
@@ -30,10 +37,10 @@ def build_graph():
     # Initialize the graph with our custom TypedDict schema
     workflow = StateGraph(AgentState)
     
-    # Add the three primary nodes
-    workflow.add_node("vision_extractor", extract_data_node)
-    workflow.add_node("code_generator", write_code_node)
-    workflow.add_node("sandbox_executor", execute_code_node)
+    # Add the three primary nodes (each wrapped in a tracing span; free when no trace is active)
+    workflow.add_node("vision_extractor", traced_node("vision_extractor", extract_data_node))
+    workflow.add_node("code_generator", traced_node("code_generator", write_code_node))
+    workflow.add_node("sandbox_executor", traced_node("sandbox_executor", execute_code_node))
     
     # Entry point
     workflow.set_entry_point("vision_extractor")
@@ -51,7 +58,8 @@ def build_graph():
         {
             "end": END,                      # Stop and return final answer
             "max_retries": END,              # Stop to save compute
-            "retry": "vision_extractor"      # Self-Correction Loop
+            "retry": "vision_extractor",     # Self-Correction Loop
+            "retry_code": "code_generator"   # Code-only fix, same extracted data
         }
     )
     
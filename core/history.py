@@ -0,0 +1,189 @@
+"""
+Compacts the self-correction error history before it is pasted into a retry prompt.
+
+`error_history` only ever grows (operator.add), and a raw traceback or an echoed stdout
+can be thousands of tokens. Every retry would otherwise pay prefill for all of it. The
+compactor keeps what the model needs to fix its output:
+  - tracebacks are reduced to the frames inside the generated script plus the exception line
+  - echoed script output / raw model output is truncated to its head and tail
+  - repeated errors are listed once with a repeat count
+  - the newest errors are kept first until the node's token budget is spent
+"""
+import os
+import re
+from dataclasses import dataclass
+from typing import Callable, List
+
+from core import tracing
+
+# Retry-history token budget per node, overridable through the environment
+DEFAULT_BUDGETS = {
+    "vision_extractor": 384,
+    "code_generator": 512,
+}
+BUDGET_ENV_VARS = {
+    "vision_extractor": "AGENT_EXTRACTOR_HISTORY_TOKENS",
+    "code_generator": "AGENT_CODER_HISTORY_TOKENS",
+}
+
+SCRIPT_FILENAME = "generated_script.py"
+MAX_ECHO_CHARS = 400     # echoed stdout / raw model output kept per error (head + tail)
+MAX_FRAMES = 3           # innermost generated-script frames kept per traceback
+
+_frame_line = re.compile(r'^\s*File "(?P<file>[^"]+)", line (?P<line>\d+)')
+_echo_markers = ("Output was:", "Raw output was:")
+
+
+@dataclass
+class CompactHistory:
+    """The entries to render into the prompt plus the token accounting for reports."""
+    entries: List[str]
+    raw_tokens: int
+    compact_tokens: int
+    dropped: int = 0
+
+    def render(self, prefix: str) -> str:
+        lines = [f"\n- {prefix}: {entry}" for entry in self.entries]
+        if self.dropped:
+            lines.append(f"\n- ({self.dropped} older error(s) omitted)")
+        return "".join(lines)
+
+
+def history_budget(node: str) -> int:
+    """Token budget for the retry history of `node` (0 disables compaction)."""
+    value = os.getenv(BUDGET_ENV_VARS.get(node, ""), "")
+    return int(value) if value else DEFAULT_BUDGETS.get(node, 512)
+
+
+def truncate_middle(text: str, max_chars: int) -> str:
+    """Keeps the head and tail of `text`; the middle is replaced by a marker."""
+    if len(text) <= max_chars:
+        return text
+    half = max_chars // 2
+    return f"{text[:half]} ...[{len(text) - 2 * half} chars truncated]... {text[-half:]}"
+
+
+def compact_traceback(text: str) -> str:
+    """
+    Reduces a Python traceback to its generated-script frames (with their source line) and
+    the final exception. Frames from the interpreter or libraries are dropped.
+    """
+    lines = text.strip().splitlines()
+    if not lines or not any(line.startswith("Traceback") for line in lines):
+        return text.strip()
+
+    # The exception is everything after the last frame's source line
+    last_frame = max(i for i, line in enumerate(lines) if _frame_line.match(line) or line.startswith("Traceback"))
+    tail = lines[last_frame + 1:]
+    if tail and _frame_line.match(lines[last_frame]) and tail[0].startswith("    "):
+        tail = tail[1:]
+    # Skip the "~~~^^^" caret markers newer interpreters print under the source line
+    tail = [line for line in tail if line.strip() and not set(line.strip()) <= set("^~ ")]
+    exception = "\n".join(tail) or lines[-1]
+
+    frames = []
+    for i, line in enumerate(lines):
+        match = _frame_line.match(line)
+        if match and match.group("file") == SCRIPT_FILENAME:
+            source = lines[i + 1].strip() if i + 1 < len(lines) and lines[i + 1].startswith("    ") else ""
+            frames.append(f"line {match.group('line')}: {source}" if source else f"line {match.group('line')}")
+    frames = frames[-MAX_FRAMES:]
+
+    if not frames:
+        return exception
+    return f"{exception} (at {' <- '.join(reversed(frames))})"
+
+
+def compact_error(error: str) -> str:
+    """Compacts a single error_history entry."""
+    text = compact_traceback(error)
+    for marker in _echo_markers:
+        head, found, echoed = text.partition(marker)
+        if found:
+            return f"{head}{marker} {truncate_middle(echoed.strip(), MAX_ECHO_CHARS)}"
+    return truncate_middle(text, MAX_ECHO_CHARS * 4)
+
+
+def _dedup_key(entry: str) -> str:
+    # Line numbers and memory addresses differ between otherwise identical failures
+    return re.sub(r"\b(?:line \d+|0x[0-9a-f]+)\b", "", entry)
+
+
+def compact_history(
+    errors: List[str],
+    budget_tokens: int,
+    count_tokens: Callable[[str], int],
+    prefix: str = "Error",
+) -> CompactHistory:
+    """
+    Compacts, deduplicates and budget-limits `errors` (oldest first). The newest distinct
+    errors are kept; what does not fit into `budget_tokens` is counted as dropped.
+    """
+    raw_tokens = count_tokens(CompactHistory(list(errors), 0, 0).render(prefix)) if errors else 0
+    if budget_tokens <= 0 or not errors:
+        return CompactHistory(list(errors), raw_tokens, raw_tokens)
+
+    # Deduplicate, remembering the most recent position of each distinct error
+    counts, latest = {}, {}
+    for position, error in enumerate(errors):
+        entry = compact_error(error)
+        key = _dedup_key(entry)
+        counts[key] = counts.get(key, 0) + 1
+        latest[key] = (position, entry)
+
+    distinct = sorted(latest.items(), key=lambda kv: kv[1][0])
+    rendered = [
+        f"{entry} (repeated {counts[key]}x)" if counts[key] > 1 else entry
+        for key, (_, entry) in distinct
+    ]
+
+    # Fill the budget newest-first, then restore chronological order
+    kept: List[str] = []
+    used = 0
+    for entry in reversed(rendered):
+        cost = count_tokens(f"\n- {prefix}: {entry}")
+        if used + cost > budget_tokens:
+            if not kept:
+                # Always keep the latest error, cut down to whatever the budget allows
+                entry = _fit(entry, budget_tokens, prefix, count_tokens)
+                kept.append(entry)
+                used += count_tokens(f"\n- {prefix}: {entry}")
+            break
+        kept.append(entry)
+        used += cost
+    kept.reverse()
+
+    history = CompactHistory(kept, raw_tokens, 0, dropped=len(rendered) - len(kept))
+    history.compact_tokens = count_tokens(history.render(prefix))
+    return history
+
+
+def _fit(entry: str, budget_tokens: int, prefix: str, count_tokens: Callable[[str], int]) -> str:
+    """Shrinks one entry (keeping head and tail) until it fits the budget."""
+    max_chars = len(entry)
+    while max_chars > 32:
+        max_chars = int(max_chars * 0.75)
+        candidate = truncate_middle(entry, max_chars)
+        if count_tokens(f"\n- {prefix}: {candidate}") <= budget_tokens:
+            return candidate
+    return truncate_middle(entry, 32)
+
+
+def render_history(
+    errors: List[str],
+    node: str,
+    prefix: str,
+    count_tokens: Callable[[str], int],
+) -> str:
+    """
+    What the nodes paste into a retry prompt: the history compacted to the node's budget.
+    The raw vs. compacted token counts are recorded on a `history.compact` span.
+    """
+    with tracing.span("history.compact", node=node):
+        history = compact_history(errors, history_budget(node), count_tokens, prefix=prefix)
+        tracing.annotate(
+            history_tokens_raw=history.raw_tokens,
+            history_tokens_compact=history.compact_tokens,
+            history_dropped=history.dropped,
+        )
+    return history.render(prefix)
@@ -0,0 +1,177 @@
+import io
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
+from utils.hashing import file_sha256
+from utils.packed import is_packed_uri, packed_image_sha256, read_image_bytes
+
+# Qwen2.5-VL: 14px patches merged 2x2, so one visual token covers a 28x28 pixel block
+PATCH_FACTOR = 28
+PIXELS_PER_TOKEN = PATCH_FACTOR * PATCH_FACTOR
+DEFAULT_MAX_PIXELS = 1280 * PIXELS_PER_TOKEN
+DEFAULT_MIN_PIXELS = 4 * PIXELS_PER_TOKEN
+# The processor's own ceiling, used when only packed images need resolving (no budget set)
+PROCESSOR_MAX_PIXELS = 16384 * PIXELS_PER_TOKEN
+
+
+def fit_to_budget(width: int, height: int, max_pixels: int, min_pixels: int = DEFAULT_MIN_PIXELS) -> Tuple[int, int]:
+    """
+    Target size for an image: both sides rounded to multiples of 28, aspect ratio kept, and
+    the area scaled down (or up) into [min_pixels, max_pixels]. Same rule as the processor's
+    smart_resize, so handing it the result does not trigger a second resize.
+    """
+    new_w = max(PATCH_FACTOR, round(width / PATCH_FACTOR) * PATCH_FACTOR)
+    new_h = max(PATCH_FACTOR, round(height / PATCH_FACTOR) * PATCH_FACTOR)
+    if new_w * new_h > max_pixels:
+        beta = math.sqrt((width * height) / max_pixels)
+        new_w = max(PATCH_FACTOR, math.floor(width / beta / PATCH_FACTOR) * PATCH_FACTOR)
+        new_h = max(PATCH_FACTOR, math.floor(height / beta / PATCH_FACTOR) * PATCH_FACTOR)
+    elif new_w * new_h < min_pixels:
+        beta = math.sqrt(min_pixels / (width * height))
+        new_w = math.ceil(width * beta / PATCH_FACTOR) * PATCH_FACTOR
+        new_h = math.ceil(height * beta / PATCH_FACTOR) * PATCH_FACTOR
+    return new_w, new_h
+
+
+def is_local_image(value) -> bool:
+    """An image the preprocessor can load: a file on disk or an image inside a packed dataset."""
+    return isinstance(value, str) and (is_packed_uri(value) or os.path.isfile(value))
+
+
+@dataclass
+class PreparedImage:
+    """A decoded, budget-resized RGB image and what it will cost the model."""
+    image: Any                 # PIL.Image.Image
+    sha256: str
+    original_size: Tuple[int, int]
+    size: Tuple[int, int]
+    visual_tokens: int
+
+    @property
+    def nbytes(self) -> int:
+        return self.size[0] * self.size[1] * 3
+
+
+class ImagePreprocessor:
+    """
+    Decodes each image file once, downsamples it to the visual-token budget and keeps the
+    result in a byte-bounded LRU keyed by file hash + budget. The engine swaps every local
+    image path in a request for the prepared image before it reaches the backend.
+    """
+
+    def __init__(self, max_pixels: int = DEFAULT_MAX_PIXELS, min_pixels: int = DEFAULT_MIN_PIXELS,
+                 cache_bytes: int = 128 * 1024 ** 2):
+        self.max_pixels = max_pixels
+        self.min_pixels = min_pixels
+        self.cache_bytes = cache_bytes
+        self._entries: "OrderedDict[str, PreparedImage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["ImagePreprocessor"]:
+        """AGENT_IMAGE_MAX_TOKENS (or AGENT_IMAGE_MAX_PIXELS) sets the budget; AGENT_IMAGE_PREPROCESS=0 disables."""
+        if os.getenv("AGENT_IMAGE_PREPROCESS", "1") == "0":
+            return None
+        max_pixels = int(os.getenv("AGENT_IMAGE_MAX_PIXELS", str(DEFAULT_MAX_PIXELS)))
+        if os.getenv("AGENT_IMAGE_MAX_TOKENS"):
+            max_pixels = int(os.getenv("AGENT_IMAGE_MAX_TOKENS")) * PIXELS_PER_TOKEN
+        return cls(
+            max_pixels=max_pixels,
+            cache_bytes=int(float(os.getenv("AGENT_IMAGE_CACHE_MB", "128")) * 1024 ** 2),
+        )
+
+    def prepare(self, path: str) -> Tuple[PreparedImage, bool]:
+        """Returns (prepared image, was_cached). `path` is a file or a packed:// dataset URI."""
+        sha = packed_image_sha256(path) if is_packed_uri(path) else file_sha256(path)
+        key = f"{sha}:{self.max_pixels}:{self.min_pixels}"
+        with self._lock:
+            prepared = self._entries.get(key)
+            if prepared is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return prepared, True
+            self.misses += 1
+
+        from PIL import Image
+
+        source_file = io.BytesIO(read_image_bytes(path)) if is_packed_uri(path) else path
+        with Image.open(source_file) as source:
+            image = source.convert("RGB")
+        original_size = image.size
+        size = fit_to_budget(*original_size, max_pixels=self.max_pixels, min_pixels=self.min_pixels)
+        if size != original_size:
+            image = image.resize(size, Image.BICUBIC)
+        prepared = PreparedImage(
+            image=image,
+            sha256=sha,
+            original_size=original_size,
+            size=size,
+            visual_tokens=(size[0] // PATCH_FACTOR) * (size[1] // PATCH_FACTOR),
+        )
+
+        if prepared.nbytes <= self.cache_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = prepared
+                    self.current_bytes += prepared.nbytes
+                while self.current_bytes > self.cache_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.current_bytes -= evicted.nbytes
+                    self.evictions += 1
+        return prepared, False
+
+    def prepare_messages(self, messages: list) -> Tuple[list, dict]:
+        """
+        Copies `messages` with each local image path replaced by its prepared image (the
+        processor then skips decoding and resizing). Returns the messages and the totals
+        (images, visual tokens, preprocessing seconds, cache hits) for tracing.
+        """
+        totals = {"images": 0, "visual_tokens": 0, "preprocess_s": 0.0, "cached": 0}
+        prepared_messages = []
+        for message in messages:
+            content = message.get("content")
+            if not isinstance(content, list):
+                prepared_messages.append(message)
+                continue
+            parts = []
+            for part in content:
+                image = part.get("image")
+                if part.get("type") == "image" and is_local_image(image):
+                    started = time.perf_counter()
+                    prepared, cached = self.prepare(image)
+                    totals["images"] += 1
+                    totals["visual_tokens"] += prepared.visual_tokens
+                    totals["preprocess_s"] += time.perf_counter() - started
+                    totals["cached"] += int(cached)
+                    part = {
+                        **part,
+                        "image": prepared.image,
+                        "image_sha256": prepared.sha256,
+                        "resized_width": prepared.size[0],
+                        "resized_height": prepared.size[1],
+                    }
+                parts.append(part)
+            prepared_messages.append({**message, "content": parts})
+        return prepared_messages, totals
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_pixels": self.max_pixels,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
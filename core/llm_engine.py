@@ -1,6 +1,31 @@
-import torch
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
-from qwen_vl_utils import process_vision_info
+import contextvars
+import dataclasses
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from core import tracing
+from core.backends import Generation, GenerationRequest, InferenceBackend, create_backend, has_image
+from core.image_preprocess import PROCESSOR_MAX_PIXELS, ImagePreprocessor
+from utils.packed import is_packed_uri
+from core.response_cache import ResponseCache, request_cache_key
+from core.scheduler import BatchScheduler
+
+# Where streamed tokens go when a caller (e.g. the Streamlit trace) is listening
+_token_sink: contextvars.ContextVar[Optional[Callable[[str], None]]] = contextvars.ContextVar("token_sink", default=None)
+
+
+@contextmanager
+def stream_tokens(callback: Callable[[str], None]):
+    """Forwards every text chunk generated inside this block (by any node) to `callback`."""
+    token = _token_sink.set(callback)
+    try:
+        yield
+    finally:
+        _token_sink.reset(token)
+
 
 class LocalAIEngine:
     """Singleton class to hold the 7B model in VRAM and process both vision and text tasks."""
@@ -13,53 +38,253 @@ class LocalAIEngine:
         return cls._instance
 
     def _initialize_model(self):
-        
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_compute_dtype=torch.bfloat16,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
+        # The backend (HF/bitsandbytes or the CPU stub) is chosen via AGENT_BACKEND
+        self.backend: InferenceBackend = create_backend()
+
+        # Decodes and downsamples images once, ahead of the backend (AGENT_IMAGE_MAX_TOKENS etc.)
+        self.preprocessor: Optional[ImagePreprocessor] = ImagePreprocessor.from_env()
+        self._packed_resolver: Optional[ImagePreprocessor] = None
+
+        # Optional on-disk response cache (AGENT_RESPONSE_CACHE=read|readwrite|off)
+        self.response_cache: Optional[ResponseCache] = ResponseCache.from_env()
+
+        # Cross-request micro-batching is opt-in: AGENT_BATCH_WINDOW_MS turns it on
+        self.scheduler: Optional[BatchScheduler] = None
+        if os.getenv("AGENT_BATCH_WINDOW_MS"):
+            self.enable_batching(
+                max_batch_size=int(os.getenv("AGENT_MAX_BATCH_SIZE", "8")),
+                max_wait_ms=float(os.getenv("AGENT_BATCH_WINDOW_MS")),
+            )
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.backend.is_loaded
+
+    def preload(self) -> float:
+        """Loads the model weights now; returns how many seconds that took."""
+        started = time.perf_counter()
+        self.backend.load()
+        return time.perf_counter() - started
+
+    def warmup(self) -> float:
+        """Preloads and runs one short text generation so kernels and caches are initialized."""
+        started = time.perf_counter()
+        self.preload()
+        self.generate_response([{"role": "user", "content": [{"type": "text", "text": "Reply with OK."}]}], max_new_tokens=4)
+        return time.perf_counter() - started
+
+    def count_tokens(self, text: str) -> int:
+        """Token count of `text` under the active backend's tokenizer."""
+        return self.backend.count_tokens(text)
+
+    def set_backend(self, backend: InferenceBackend):
+        """Swaps the inference backend, e.g. to the deterministic stub in load tests."""
+        self.backend = backend
+
+    def set_response_cache(self, cache: Optional[ResponseCache]):
+        """Installs (or with None, removes) the persistent response cache."""
+        if self.response_cache is not None and self.response_cache is not cache:
+            self.response_cache.close()
+        self.response_cache = cache
+
+    def enable_batching(self, max_batch_size: int = 8, max_wait_ms: float = 5.0) -> BatchScheduler:
+        """Routes every generate call from concurrent graph runs through one micro-batcher."""
+        self.disable_batching()
+        self.scheduler = BatchScheduler(
+            lambda requests: self.backend.generate(requests),
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
         )
-        
-        self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            "Qwen/Qwen2.5-VL-7B-Instruct",
-            device_map="auto",
-            quantization_config=bnb_config
+        return self.scheduler
+
+    def disable_batching(self):
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
+
+    def stats(self) -> dict:
+        """Cache and batching counters from the backend and the scheduler."""
+        stats = dict(self.backend.stats())
+        if self.preprocessor is not None:
+            stats["image_preprocess"] = self.preprocessor.stats()
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.stats()
+        if self.scheduler is not None:
+            stats["scheduler"] = self.scheduler.stats()
+        return stats
+
+    def generate_batch(
+        self,
+        list_of_messages: List[list],
+        max_new_tokens: int = 512,
+        stop: Optional[str] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        constraint: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Runs several conversations through the model in a single padded generate call.
+        `stop` ends each row early once its JSON object / code block is complete, and
+        `on_token` (or the surrounding stream_tokens() block) receives the streamed text.
+        `constraint` masks every token that would leave the named schema (core/constrained.py).
+        """
+        on_token = on_token or _token_sink.get()
+        requests = [
+            GenerationRequest(
+                messages=messages, max_new_tokens=max_new_tokens, stop=stop, on_token=on_token, constraint=constraint
+            )
+            for messages in list_of_messages
+        ]
+        return [generation.text for generation in self._complete(requests)]
+
+    def generate_candidates(
+        self,
+        messages: list,
+        num_candidates: int,
+        temperature: float = 0.7,
+        max_new_tokens: int = 512,
+        stop: Optional[str] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> List[str]:
+        """
+        Samples `num_candidates` independent completions of one conversation in a single
+        generate call (num_return_sequences). Only the first sample is streamed.
+        """
+        request = GenerationRequest(
+            messages=messages,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            on_token=on_token or _token_sink.get(),
+            num_return_sequences=num_candidates,
+            temperature=temperature if num_candidates > 1 else 0.0,
         )
-        self.processor = AutoProcessor.from_pretrained("Qwen/Qwen2.5-VL-7B-Instruct")
+        generation = self._complete([request])[0]
+        return generation.candidates or [generation.text]
 
-    def generate_response(self, messages: list) -> str:
+    def generate_response(
+        self,
+        messages: list,
+        max_new_tokens: int = 512,
+        stop: Optional[str] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        constraint: Optional[str] = None,
+    ) -> str:
         """Handles the actual inference generation."""
-        # Process the chat template
-        text = self.processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        
-        # Handle vision components if they exist in the messages
-        image_inputs, video_inputs = process_vision_info(messages)
-        
-        # Send inputs to GPU
-        inputs = self.processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        ).to("cuda")
-
-        # Generate output
-        with torch.no_grad():
-            generated_ids = self.model.generate(**inputs, max_new_tokens=512)
-            
-        # Trim prompt tokens from output
-        generated_ids_trimmed = [
-            out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
-        
-        output_text = self.processor.batch_decode(
-            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        return self.generate_batch(
+            [messages], max_new_tokens=max_new_tokens, stop=stop, on_token=on_token, constraint=constraint
+        )[0]
+
+    def _complete(self, requests: List[GenerationRequest]) -> List[Generation]:
+        with tracing.span("llm.generate", batch_size=len(requests)):
+            started = time.perf_counter()
+            generations = self._generate(requests)
+            self._annotate(requests, generations, time.perf_counter() - started)
+        return generations
+
+    @staticmethod
+    def _annotate(requests: List[GenerationRequest], generations: List[Generation], elapsed_s: float):
+        """Records token counts and the prefill/decode/queueing split on the current span."""
+        prefill_s = max((g.prefill_s for g in generations), default=0.0)
+        decode_s = max((g.decode_s for g in generations), default=0.0)
+        completion_tokens = sum(g.completion_tokens for g in generations)
+        tracing.annotate(
+            kind="vision" if any(has_image(r.messages) for r in requests) else "text",
+            prompt_tokens=sum(g.prompt_tokens for g in generations),
+            completion_tokens=completion_tokens,
+            prefill_s=prefill_s,
+            decode_s=decode_s,
+            # Time spent waiting for the micro-batcher / device rather than computing
+            queue_s=max(elapsed_s - prefill_s - decode_s, 0.0),
+            tokens_per_s=(completion_tokens / decode_s) if decode_s > 0 else 0.0,
+            cached=sum(1 for g in generations if g.cached),
         )
-        return output_text[0]
 
-# Instantiate the singleton so it's ready to import
-ai_engine = LocalAIEngine()
\ No newline at end of file
+    def _generate(self, requests: List[GenerationRequest]) -> List[Generation]:
+        cache = self.response_cache
+        if cache is None or cache.mode == "off":
+            return self._run_backend(requests)
+
+        # Serve byte-identical calls from disk and only send the misses to the model
+        fingerprint = self.backend.fingerprint()
+        keys = [request_cache_key(request, fingerprint) for request in requests]
+        generations = [cache.get(key) for key in keys]
+        missing = [i for i, generation in enumerate(generations) if generation is None]
+        for request, generation in zip(requests, generations):
+            # A cache hit has nothing to stream, so listeners get the whole text at once
+            if generation is not None and request.on_token is not None:
+                request.on_token(generation.text)
+        if missing:
+            fresh = self._run_backend([requests[i] for i in missing])
+            for i, generation in zip(missing, fresh):
+                generations[i] = generation
+                cache.put(keys[i], generation)
+        return generations
+
+    def _run_backend(self, requests: List[GenerationRequest]) -> List[Generation]:
+        if not requests:
+            return []
+        requests = self._preprocess_images(requests)
+        if self.scheduler is None:
+            return self.backend.generate(requests)
+        # Each request joins whatever batch the scheduler is currently filling
+        futures = [self.scheduler.submit(request) for request in requests]
+        return [future.result() for future in futures]
+
+    def _preprocess_images(self, requests: List[GenerationRequest]) -> List[GenerationRequest]:
+        """Hands the backend decoded, budget-sized images instead of file paths."""
+        preprocessor = self.preprocessor
+        if preprocessor is None and any(_has_packed_image(r.messages) for r in requests):
+            # Packed dataset images only exist inside the pack, so they are always resolved here
+            if self._packed_resolver is None:
+                self._packed_resolver = ImagePreprocessor(max_pixels=PROCESSOR_MAX_PIXELS, cache_bytes=0)
+            preprocessor = self._packed_resolver
+        if preprocessor is None or not any(has_image(r.messages) for r in requests):
+            return requests
+        with tracing.span("image.preprocess") as record:
+            prepared = []
+            totals = {"images": 0, "visual_tokens": 0, "preprocess_s": 0.0, "cached": 0}
+            for request in requests:
+                messages, counts = preprocessor.prepare_messages(request.messages)
+                prepared.append(dataclasses.replace(request, messages=messages))
+                for key, value in counts.items():
+                    totals[key] += value
+            if record is not None:
+                record.attrs.update(totals)
+        return prepared
+
+
+def _has_packed_image(messages: list) -> bool:
+    return any(
+        isinstance(message.get("content"), list)
+        and any(part.get("type") == "image" and is_packed_uri(part.get("image")) for part in message["content"])
+        for message in messages
+    )
+
+
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> LocalAIEngine:
+    """Returns the process-wide engine, constructing it on first call."""
+    if LocalAIEngine._instance is None:
+        with _engine_lock:
+            return LocalAIEngine()
+    return LocalAIEngine._instance
+
+
+class _LazyEngine:
+    """
+    Import-time stand-in for the singleton. Importing the graph, nodes or tests must not
+    load torch or the 7B weights, so the engine is only built when an attribute is first
+    used, and the model itself only on the first inference (or an explicit preload()).
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_engine(), name)
+
+    def __repr__(self):
+        loaded = LocalAIEngine._instance is not None and LocalAIEngine._instance.is_loaded
+        return f"<lazy LocalAIEngine ({'loaded' if loaded else 'not loaded'})>"
+
+
+# Importable handle used by the nodes; nothing heavy happens until it is first called
+ai_engine = _LazyEngine()
@@ -0,0 +1,129 @@
+"""
+Multi-query mode: extract a chart once, answer many questions about it.
+
+The per-query graph re-reads the image for every question. Here one full-table extraction
+per image (cached by image content hash) is shared by all of its queries, their scripts
+are generated in one batched call and run side by side in the sandbox. A query only gets
+its own extraction, through the regular graph, when its script reports missing data.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from core import tracing
+from core.llm_engine import ai_engine
+from core.state import initial_state
+from nodes.coder import build_code_messages, extract_python_code
+from nodes.executor import execute_many, reports_missing_data
+from nodes.extractor import extract_table
+from utils.hashing import file_sha256
+from utils.packed import is_packed_uri, packed_image_sha256
+
+# Code attempts against the shared table; a re-extracting query keeps the rest of the graph's loop cap
+MAX_TABLE_ATTEMPTS = 2
+
+_tables: "OrderedDict[str, dict]" = OrderedDict()
+_tables_lock = threading.Lock()
+
+
+def _image_key(image_path: str) -> str:
+    if is_packed_uri(image_path):
+        return packed_image_sha256(image_path)
+    # URLs (or anything else the processor loads itself) are keyed by their location
+    return file_sha256(image_path) if os.path.isfile(image_path) else image_path
+
+
+def shared_table(image_path: str) -> Tuple[dict, bool]:
+    """(full-table extraction for the image, was_cached). Failed extractions are not cached."""
+    key = _image_key(image_path)
+    with _tables_lock:
+        table = _tables.get(key)
+        if table is not None:
+            _tables.move_to_end(key)
+            return table, True
+
+    with tracing.span("node.vision_extractor", node="vision_extractor", table=True):
+        table = extract_table(image_path)
+
+    if "extraction_error" not in table:
+        with _tables_lock:
+            _tables[key] = table
+            _tables.move_to_end(key)
+            while len(_tables) > int(os.getenv("AGENT_TABLE_CACHE_SIZE", "64")):
+                _tables.popitem(last=False)
+    return table, False
+
+
+def answer_queries(image_path: str, queries: List[str], app=None) -> List[dict]:
+    """
+    Answers every query about one image. Returns one result per query, in order:
+    final_answer, loops, error_history and how it was answered ("table" for the shared
+    extraction, "re-extracted" for the per-query graph, or "failed").
+    `app` is the compiled per-query graph used for re-extraction (built on demand).
+    """
+    results: List[Optional[dict]] = [None] * len(queries)
+    errors = [[] for _ in queries]
+    re_extract = []
+
+    with tracing.span("multi_query", queries=len(queries)) as record:
+        table, cached = shared_table(image_path)
+        pending = list(range(len(queries))) if "extraction_error" not in table else []
+        if not pending:
+            # Nothing usable to share: every query falls back to its own extraction
+            re_extract = list(range(len(queries)))
+            for i in re_extract:
+                errors[i].append(table["extraction_error"])
+
+        attempts = 0
+        while pending and attempts < MAX_TABLE_ATTEMPTS:
+            attempts += 1
+            # All pending queries' scripts in one batched generate call
+            with tracing.span("node.code_generator", node="code_generator", batch_size=len(pending)):
+                raw_responses = ai_engine.generate_batch(
+                    [build_code_messages(table, queries[i], errors[i], shared_table=True) for i in pending],
+                    stop="python_block",
+                )
+                with tracing.span("parse.code"):
+                    codes = [extract_python_code(raw) for raw in raw_responses]
+            with tracing.span("node.sandbox_executor", node="sandbox_executor", batch_size=len(pending)):
+                updates = execute_many(codes)
+
+            retry = []
+            for i, update in zip(pending, updates):
+                if "final_answer" in update:
+                    results[i] = _result(queries[i], update["final_answer"], attempts, errors[i], "table")
+                    continue
+                errors[i].extend(update.get("error_history", []))
+                if reports_missing_data(update):
+                    re_extract.append(i)
+                else:
+                    retry.append(i)
+            pending = retry
+
+        for i in pending:
+            results[i] = _result(queries[i], "", attempts, errors[i], "failed")
+
+        if re_extract:
+            if app is None:
+                from core.graph import build_graph
+                app = build_graph()
+            for i in sorted(re_extract):
+                # The graph's extractor sees why the shared table was not enough
+                state = {**initial_state(image_path, queries[i]), "error_history": list(errors[i]), "loop_count": attempts}
+                final_state = app.invoke(state)
+                answer = final_state.get("final_answer", "")
+                results[i] = _result(queries[i], answer, final_state.get("loop_count", attempts),
+                                     final_state.get("error_history", []), "re-extracted" if answer else "failed")
+
+        if record is not None:
+            record.attrs.update(
+                table_cached=cached,
+                answered_from_table=sum(1 for r in results if r["path"] == "table"),
+                re_extracted=len(re_extract),
+            )
+    return results
+
+
+def _result(query: str, answer: str, loops: int, error_history: List[str], path: str) -> dict:
+    return {"query": query, "final_answer": answer, "loops": loops, "error_history": list(error_history), "path": path}
@@ -0,0 +1,209 @@
+import fcntl
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+from core.backends import Generation, GenerationRequest
+from utils.hashing import bytes_sha256, file_sha256
+from utils.packed import is_packed_uri, packed_image_sha256
+
+CACHE_MODES = ("off", "read", "readwrite")
+
+
+def request_cache_key(request: GenerationRequest, backend_fingerprint: str) -> str:
+    """
+    Content address of a generate call: the normalized messages (with every local image
+    path replaced by the hash of its bytes), the generation config and the backend/model.
+    """
+    def normalize(value):
+        if isinstance(value, dict):
+            if value.get("type") == "image" and isinstance(value.get("image"), str) and os.path.isfile(value["image"]):
+                value = {**value, "image": "sha256:" + file_sha256(value["image"])}
+            elif value.get("type") == "image" and is_packed_uri(value.get("image")):
+                value = {**value, "image": "sha256:" + packed_image_sha256(value["image"])}
+            return {k: normalize(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [normalize(v) for v in value]
+        return value
+
+    payload = {
+        "backend": backend_fingerprint,
+        "config": request.generation_config(),
+        "messages": normalize(request.messages),
+    }
+    return bytes_sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of LLM outputs.
+
+    Records are zlib-compressed JSON appended to `responses.dat`; `index.jsonl` is an
+    append-only log of (key, offset, length) entries and evictions, replayed once at
+    startup so lookups are a dict hit plus one pread. When the live data exceeds
+    `max_bytes` the least-recently-used entries are evicted, and the files are compacted
+    once dead records outweigh live ones.
+
+    Modes: "readwrite" (serve hits, store misses), "read" (serve hits, never write — for
+    frozen benchmark reruns) and "off" (bypass entirely).
+    """
+
+    def __init__(self, directory: str, mode: str = "readwrite", max_bytes: int = 512 * 1024 ** 2):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown response cache mode '{mode}'. Expected one of {CACHE_MODES}.")
+        self.directory = directory
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (offset, length)
+        self.live_bytes = 0
+        self.dead_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+
+        self._data_path = os.path.join(directory, "responses.dat")
+        self._index_path = os.path.join(directory, "index.jsonl")
+        if mode != "off":
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+            self._data = open(self._data_path, "ab+")
+            self._index_log = open(self._index_path, "a")
+
+    @classmethod
+    def from_env(cls) -> Optional["ResponseCache"]:
+        mode = os.getenv("AGENT_RESPONSE_CACHE", "off").lower()
+        if mode == "off":
+            return None
+        return cls(
+            os.getenv("AGENT_RESPONSE_CACHE_DIR", os.path.join(".cache", "responses")),
+            mode=mode,
+            max_bytes=int(float(os.getenv("AGENT_RESPONSE_CACHE_MB", "512")) * 1024 ** 2),
+        )
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A torn final line from a crashed writer
+                key = record["k"]
+                if key in self._index:
+                    self._drop(key)
+                if not record.get("d"):
+                    self._index[key] = (record["o"], record["n"])
+                    self.live_bytes += record["n"]
+
+    def _drop(self, key: str):
+        _, length = self._index.pop(key)
+        self.live_bytes -= length
+        self.dead_bytes += length
+
+    # --- Lookups ---
+    def get(self, key: str) -> Optional[Generation]:
+        if self.mode == "off":
+            return None
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            offset, length = location
+            blob = os.pread(self._data.fileno(), length, offset)
+        record = json.loads(zlib.decompress(blob))
+        return Generation(
+            text=record["text"],
+            prompt_tokens=record.get("prompt_tokens", 0),
+            completion_tokens=record.get("completion_tokens", 0),
+            cached=True,
+            candidates=record.get("candidates", []),
+        )
+
+    def put(self, key: str, generation: Generation):
+        if self.mode != "readwrite":
+            return
+        blob = zlib.compress(json.dumps({
+            "text": generation.text,
+            "prompt_tokens": generation.prompt_tokens,
+            "completion_tokens": generation.completion_tokens,
+            "candidates": generation.candidates,
+        }).encode("utf-8"))
+
+        with self._lock:
+            # flock keeps concurrent benchmark shards from interleaving their appends
+            fcntl.flock(self._data.fileno(), fcntl.LOCK_EX)
+            try:
+                self._data.seek(0, os.SEEK_END)
+                offset = self._data.tell()
+                self._data.write(blob)
+                self._data.flush()
+            finally:
+                fcntl.flock(self._data.fileno(), fcntl.LOCK_UN)
+
+            if key in self._index:
+                self._drop(key)
+            self._index[key] = (offset, len(blob))
+            self.live_bytes += len(blob)
+            self.writes += 1
+            self._append_index({"k": key, "o": offset, "n": len(blob)})
+
+            while self.live_bytes > self.max_bytes and len(self._index) > 1:
+                evicted_key = next(iter(self._index))
+                self._drop(evicted_key)
+                self.evictions += 1
+                self._append_index({"k": evicted_key, "d": 1})
+
+            if self.dead_bytes > max(self.live_bytes, 1024 ** 2):
+                self._compact()
+
+    def _append_index(self, record: dict):
+        self._index_log.write(json.dumps(record) + "\n")
+        self._index_log.flush()
+
+    def _compact(self):
+        """Rewrites both files with only the live records (caller holds the lock)."""
+        tmp_data_path, tmp_index_path = self._data_path + ".tmp", self._index_path + ".tmp"
+        new_index: "OrderedDict[str, tuple]" = OrderedDict()
+        with open(tmp_data_path, "wb") as data_out, open(tmp_index_path, "w") as index_out:
+            for key, (offset, length) in self._index.items():
+                new_offset = data_out.tell()
+                data_out.write(os.pread(self._data.fileno(), length, offset))
+                new_index[key] = (new_offset, length)
+                index_out.write(json.dumps({"k": key, "o": new_offset, "n": length}) + "\n")
+
+        self._data.close()
+        self._index_log.close()
+        os.replace(tmp_data_path, self._data_path)
+        os.replace(tmp_index_path, self._index_path)
+        self._data = open(self._data_path, "ab+")
+        self._index_log = open(self._index_path, "a")
+        self._index = new_index
+        self.dead_bytes = 0
+
+    def close(self):
+        if self.mode != "off":
+            self._data.close()
+            self._index_log.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "mode": self.mode,
+                "entries": len(self._index),
+                "bytes": self.live_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
@@ -0,0 +1,111 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Tuple
+
+from core.backends import Generation, GenerationRequest
+
+
+class BatchScheduler:
+    """
+    Cross-request micro-batcher that sits in front of the backend.
+
+    Concurrent graph runs (threads or asyncio tasks) submit single requests; a background
+    thread collects them and flushes one batched generate call as soon as either
+    `max_batch_size` requests are pending or the oldest one has waited `max_wait_ms`.
+    Each Generation is routed back to the Future of the caller that submitted it.
+    """
+
+    def __init__(
+        self,
+        generate_fn: Callable[[List[GenerationRequest]], List[Generation]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 5.0,
+    ):
+        self.generate_fn = generate_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_s = max(0.0, max_wait_ms) / 1000
+        self._queue: "queue.Queue[Tuple[GenerationRequest, Future]]" = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.batched_requests = 0
+        self._worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, request: GenerationRequest) -> Future:
+        """Queues a request and returns a Future resolving to its Generation."""
+        if self._closed:
+            raise RuntimeError("BatchScheduler is closed.")
+        future: Future = Future()
+        self._queue.put((request, future))
+        return future
+
+    async def submit_async(self, request: GenerationRequest) -> Generation:
+        """asyncio-friendly variant of submit()."""
+        return await asyncio.wrap_future(self.submit(request))
+
+    def close(self):
+        """Stops the worker after it drains whatever is already queued."""
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "requests": self.batched_requests,
+                "mean_batch_size": (self.batched_requests / self.batches) if self.batches else 0.0,
+            }
+
+    # --- Worker loop ---
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            # The first request opens the batch window; keep collecting until it fills or expires
+            batch = [item]
+            deadline = time.perf_counter() + self.max_wait_s
+            stop_after_flush = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop_after_flush = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+            if stop_after_flush:
+                return
+
+    def _flush(self, batch: List[Tuple[GenerationRequest, Future]]):
+        # Skip callers that gave up (e.g. a cancelled asyncio task) before we ran
+        batch = [(request, future) for request, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        with self._lock:
+            self.batches += 1
+            self.batched_requests += len(batch)
+
+        try:
+            generations = self.generate_fn([request for request, _ in batch])
+        except Exception as e:
+            # A failed batch fails every caller in it rather than hanging them
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), generation in zip(batch, generations):
+            future.set_result(generation)
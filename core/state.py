@@ -16,6 +16,9 @@ class AgentState(TypedDict):
     
     # The Python code generated to process that data and answer the query
     generated_code: str            
+
+    # All K sampled scripts when candidate generation is on (AGENT_CANDIDATES > 1), else empty
+    candidate_codes: List[str]
     
     # The stdout or traceback from running the code
     execution_result: str          
@@ -27,6 +30,26 @@ class AgentState(TypedDict):
     
     # To prevent infinite billing or infinite loops, we hard-cap the retries
     loop_count: int                
+
+    # Why the last execution failed ("extraction", "code", "logic", "timeout" or "" for none).
+    # Code bugs are retried from the coder alone, without a new pass over the image.
+    failure_type: str
     
     # --- Output ---
-    final_answer: str
\ No newline at end of file
+    final_answer: str
+
+
+def initial_state(image_path: str, user_query: str) -> AgentState:
+    """A fresh state for one (image, query) job, as every entry point starts the graph with."""
+    return {
+        "image_path": image_path,
+        "user_query": user_query,
+        "extracted_data": {},
+        "generated_code": "",
+        "candidate_codes": [],
+        "execution_result": "",
+        "error_history": [],
+        "loop_count": 0,
+        "failure_type": "",
+        "final_answer": ""
+    }
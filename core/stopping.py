@@ -0,0 +1,94 @@
+import re
+from typing import Optional
+
+
+class StructuralStop:
+    """
+    Incremental detector fed with decoded text as it streams out of the model.
+    `feed()` returns True once the structure the caller is waiting for is complete, so
+    generation can stop instead of running to max_new_tokens.
+    """
+
+    def feed(self, chunk: str) -> bool:
+        raise NotImplementedError
+
+
+class JsonObjectStop(StructuralStop):
+    """Complete as soon as the first top-level JSON object's braces balance (string-aware)."""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.consumed = 0      # characters fed so far
+        self.end_index = None  # offset just past the closing brace, once found
+
+    def feed(self, chunk: str) -> bool:
+        if self.end_index is not None:
+            return True
+        for i, char in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"' and self.started:
+                self.in_string = True
+            elif char == "{":
+                self.started = True
+                self.depth += 1
+            elif char == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end_index = self.consumed + i + 1
+                    self.consumed += len(chunk)
+                    return True
+        self.consumed += len(chunk)
+        return False
+
+
+class CodeFenceStop(StructuralStop):
+    """Complete once a ```python block (or a bare ``` block) has been closed."""
+    _opening = re.compile(r"```[ \t]*(?:python|py)?[ \t]*\n")
+
+    def __init__(self):
+        self.text = ""
+        self.body_start = None
+
+    def feed(self, chunk: str) -> bool:
+        self.text += chunk
+        if self.body_start is None:
+            match = self._opening.search(self.text)
+            if match is None:
+                return False
+            self.body_start = match.end()
+        return "```" in self.text[self.body_start:]
+
+
+STOP_KINDS = {
+    "json": JsonObjectStop,
+    "python_block": CodeFenceStop,
+}
+
+
+def make_stop(kind: Optional[str]) -> Optional[StructuralStop]:
+    """Builds a fresh detector for a request's `stop` kind (None means run to max_new_tokens)."""
+    if kind is None:
+        return None
+    if kind not in STOP_KINDS:
+        raise ValueError(f"Unknown stop kind '{kind}'. Expected one of {sorted(STOP_KINDS)}.")
+    return STOP_KINDS[kind]()
+
+
+def first_json_object(text: str) -> Optional[str]:
+    """The first balanced {...} in the text, even if a closing ``` fence never arrived."""
+    start = text.find("{")
+    if start == -1:
+        return None
+    detector = JsonObjectStop()
+    if detector.feed(text[start:]):
+        return text[start:start + detector.end_index]
+    return None
@@ -0,0 +1,167 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from utils.metrics import percentile
+
+
+@dataclass
+class Span:
+    """One timed unit of work (a graph node, an LLM call, a sandbox run...)."""
+    name: str
+    start: float                     # wall clock (time.time), for exporting timelines
+    duration_s: float = 0.0
+    parent: Optional[str] = None
+    thread_id: int = 0
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "start": self.start,
+            "duration_s": self.duration_s,
+            "parent": self.parent,
+            "thread_id": self.thread_id,
+            "attrs": self.attrs,
+        }
+
+
+class Trace:
+    """All spans recorded during one graph run."""
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"trace_id": self.trace_id, "spans": [span.to_dict() for span in self.spans]}
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_run(trace_id: str):
+    """Collects every span recorded (in this context) while the block runs."""
+    trace = Trace(str(trace_id))
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Times a block as a child of the current span. A no-op outside of trace_run()."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    parent = _current_span.get()
+    record = Span(
+        name=name,
+        start=time.time(),
+        parent=parent.name if parent else None,
+        thread_id=threading.get_ident(),
+        attrs=dict(attrs),
+    )
+    token = _current_span.set(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.duration_s = time.perf_counter() - started
+        _current_span.reset(token)
+        trace.add(record)
+
+
+def annotate(**attrs):
+    """Attaches attributes (token counts, timings...) to the innermost open span."""
+    record = _current_span.get()
+    if record is not None:
+        record.attrs.update(attrs)
+
+
+def traced_node(name: str, node_fn: Callable[[dict], dict]) -> Callable[[dict], dict]:
+    """Wraps a LangGraph node so each call is recorded as a span tagged with its loop iteration."""
+    @functools.wraps(node_fn)
+    def wrapper(state):
+        with span(f"node.{name}", node=name) as record:
+            update = node_fn(state)
+            if record is not None:
+                record.attrs["iteration"] = update.get("loop_count", state.get("loop_count", 0))
+            return update
+    return wrapper
+
+
+# --- Export ---
+def to_chrome_trace(traces: Iterable[dict]) -> dict:
+    """Converts trace dicts to the Chrome trace-event format (chrome://tracing, Perfetto)."""
+    events = []
+    for pid, trace in enumerate(traces):
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"run {trace['trace_id']}"}})
+        for record in trace["spans"]:
+            events.append({
+                "name": record["name"],
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["duration_s"] * 1e6,
+                "pid": pid,
+                "tid": record["thread_id"],
+                "args": record["attrs"],
+            })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_traces(traces: List[dict], directory: str):
+    """Writes traces.json (raw spans) and chrome_trace.json next to each other."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "traces.json"), "w") as f:
+        json.dump(traces, f)
+    with open(os.path.join(directory, "chrome_trace.json"), "w") as f:
+        json.dump(to_chrome_trace(traces), f)
+
+
+# --- Aggregation ---
+def aggregate_spans(traces: Iterable[dict]) -> Dict[str, dict]:
+    """Per span name: call count, total/mean/p50/p99 time and the summed numeric attributes."""
+    durations: Dict[str, List[float]] = {}
+    totals: Dict[str, Dict[str, float]] = {}
+    for trace in traces:
+        for record in trace["spans"]:
+            durations.setdefault(record["name"], []).append(record["duration_s"])
+            sums = totals.setdefault(record["name"], {})
+            for key, value in record["attrs"].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and key != "iteration":
+                    sums[key] = sums.get(key, 0) + value
+
+    summary = {}
+    for name, values in durations.items():
+        summary[name] = {
+            "calls": len(values),
+            "total_s": sum(values),
+            "mean_s": sum(values) / len(values),
+            "p50_s": percentile(values, 50),
+            "p99_s": percentile(values, 99),
+            "attrs": totals[name],
+        }
+    return summary
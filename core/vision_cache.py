@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+def tensor_nbytes(value: Any) -> int:
+    """Recursively sums the storage of tensors held in tuples/lists/dicts/model outputs."""
+    if hasattr(value, "element_size") and hasattr(value, "numel"):
+        return value.element_size() * value.numel()
+    if isinstance(value, dict):
+        return sum(tensor_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in value)
+    if hasattr(value, "to_tuple"):
+        return sum(tensor_nbytes(v) for v in value.to_tuple())
+    return 0
+
+
+class VisionCache:
+    """
+    LRU cache, bounded by a memory budget, mapping an image content hash to its
+    preprocessed pixel tensors and vision-tower embeddings. A self-correction retry or a
+    second query on the same chart then skips both decoding and the vision encoder.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: str, entry: dict) -> bool:
+        """Stores an entry; returns False if it alone is larger than the whole budget."""
+        nbytes = tensor_nbytes(entry)
+        if nbytes > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (entry, nbytes)
+            self.current_bytes += nbytes
+            # Evict least-recently-used images until we are back under budget
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
@@ -0,0 +1,88 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# Add root to path so we can import the engine
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from core.backends import StubBackend
+from core.llm_engine import LocalAIEngine
+from utils.metrics import latency_summary
+
+# A text-only coder-style prompt: cheap to build, exercises the same generate path as the nodes
+SAMPLE_MESSAGES = [
+    {"role": "system", "content": "You write executable Python code without markdown filler."},
+    {"role": "user", "content": [{"type": "text", "text": "Data: {'2019': 10, '2020': 12}\nUser Query: \"What is the growth?\""}]},
+]
+
+
+def _client(engine, num_requests: int, latencies: list, lock: threading.Lock):
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        engine.generate_response(SAMPLE_MESSAGES)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+
+def run_batching_benchmark(windows_ms, concurrency: int, requests_per_client: int, max_batch_size: int):
+    """
+    Drives `concurrency` closed-loop clients against the engine for each batch window and
+    reports throughput and p50/p99 latency. A window of 0 disables the scheduler (batch size 1).
+    """
+    engine = LocalAIEngine()
+
+    print(f"Backend: {engine.backend.name} | clients: {concurrency} | requests/client: {requests_per_client} | max batch: {max_batch_size}\n")
+    print(f"{'window_ms':>10} {'req/s':>10} {'p50_ms':>10} {'p99_ms':>10} {'mean_batch':>11}")
+
+    for window in windows_ms:
+        if window > 0:
+            scheduler = engine.enable_batching(max_batch_size=max_batch_size, max_wait_ms=window)
+        else:
+            engine.disable_batching()
+            scheduler = None
+
+        latencies, lock = [], threading.Lock()
+        clients = [
+            threading.Thread(target=_client, args=(engine, requests_per_client, latencies, lock))
+            for _ in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        wall_time = time.perf_counter() - start
+
+        summary = latency_summary(latencies, wall_time)
+        mean_batch = scheduler.stats()["mean_batch_size"] if scheduler else 1.0
+        print(f"{window:>10g} {summary['throughput_rps']:>10.1f} {summary['p50_s'] * 1000:>10.1f} "
+              f"{summary['p99_s'] * 1000:>10.1f} {mean_batch:>11.2f}")
+
+    engine.disable_batching()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cross-request micro-batching throughput and latency.")
+    parser.add_argument("--windows", default="0,1,2,5,10", help="Comma-separated batch windows in ms (0 = no batching).")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=20, help="Requests issued by each client.")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--stub-latency-ms", type=float, default=40.0, help="Simulated fixed cost per batch (stub backend).")
+    parser.add_argument("--stub-per-item-ms", type=float, default=5.0, help="Simulated cost per batch row (stub backend).")
+    args = parser.parse_args()
+
+    engine = LocalAIEngine()
+    if engine.backend.name == "stub":
+        engine.set_backend(StubBackend(latency_s=args.stub_latency_ms / 1000, per_item_latency_s=args.stub_per_item_ms / 1000))
+
+    run_batching_benchmark(
+        [float(w) for w in args.windows.split(",")],
+        concurrency=args.concurrency,
+        requests_per_client=args.requests,
+        max_batch_size=args.max_batch_size,
+    )
@@ -1,8 +1,13 @@
+import argparse
+import glob
+import itertools
 import json
-import time
-import torch
-import sys
+import multiprocessing
 import os
+import shutil
+import sys
+import threading
+import time
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -10,98 +15,467 @@ load_dotenv()
 # Add root to path so we can import our graph
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from core.graph import build_graph
+from core.llm_engine import get_engine
+from core.multi_query import answer_queries
+from core.state import initial_state
+from core.tracing import aggregate_spans, trace_run, write_traces
+from utils.metrics import latency_summary
+from utils.packed import PackedDataset, is_packed_dataset
+from utils.sandbox import sandbox_stats
 
-def run_benchmark(dataset_path: str):
-    print("Initializing Benchmark Suite...")
-    
-    # Load the evaluation dataset
+# Shard checkpoints are appended from several threads in the same process
+_checkpoint_lock = threading.Lock()
+
+
+def load_items(dataset_path: str, limit: int = None) -> list:
+    """
+    Loads the evaluation ledger and gives every item a stable id (its position). A packed
+    dataset directory (utils/packed.py) is streamed instead: only the first `limit` records
+    are read, and images stay in the memory-mapped shards until the engine needs them.
+    """
+    if is_packed_dataset(dataset_path):
+        return list(itertools.islice(PackedDataset(dataset_path), limit))
     with open(dataset_path, 'r') as f:
         dataset = json.load(f)
-        
-    app = build_graph()
-    
-    results = {
-        "total_tested": len(dataset),
-        "baseline_correct": 0,       # Got it right on the very first try (0 loops)
-        "self_corrected_correct": 0, # Got it right ONLY after looping and fixing an error
-        "failed": 0,                 # Never got it right, even after max retries
-        "total_loops_triggered": 0,
-        "average_time_seconds": 0.0
+    return [{"id": item.get("id", i), **item} for i, item in enumerate(dataset)][:limit]
+
+
+def load_completed(checkpoint_dir: str) -> dict:
+    """All finished records found in any shard file, keyed by item id (last write wins)."""
+    records = {}
+    for path in sorted(glob.glob(os.path.join(checkpoint_dir, "shard-*.jsonl"))):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A torn last line from a crash; that item simply reruns
+                records[record["id"]] = record
+    return records
+
+
+def _cuda():
+    """torch.cuda when the engine has loaded torch and a GPU is present, else None."""
+    # Only look at torch if the backend already imported it; stub runs never pay that import
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+def evaluate_item(app, item: dict) -> dict:
+    """Runs the agent on one item and returns a JSON-serializable result record."""
+    # Reset PyTorch memory stats for this specific run
+    cuda = _cuda()
+    if cuda is not None:
+        cuda.reset_peak_memory_stats()
+
+    start_time = time.time()
+    error = None
+    with trace_run(item["id"]) as trace:
+        try:
+            # Run the agent synchronously for the benchmark
+            final_state = app.invoke(initial_state(item["image_path"], item["query"]))
+        except Exception as e:
+            final_state, error = {}, f"{type(e).__name__}: {e}"
+    execution_time = time.time() - start_time
+
+    # Hardware Profiling
+    peak_vram_gb = 0
+    if cuda is not None:
+        peak_vram_gb = cuda.max_memory_allocated() / (1024 ** 3)
+
+    actual_answer = final_state.get("final_answer", "").strip()
+    expected = item["expected_answer"].strip()
+
+    # Retries routed straight to the coder skip a vision call (one per code-only retry)
+    node_calls = [s.name for s in trace.spans]
+    vision_calls = node_calls.count("node.vision_extractor")
+    vision_seconds = sum(s.duration_s for s in trace.spans if s.name == "node.vision_extractor")
+
+    # Evaluation Logic
+    # (For a real project, you might use an LLM-as-a-judge here instead of strict string matching)
+    return {
+        "id": item["id"],
+        "image_path": item["image_path"],
+        "query": item["query"],
+        "expected_answer": expected,
+        "final_answer": actual_answer,
+        "correct": bool(actual_answer) and expected in actual_answer,
+        "loops": final_state.get("loop_count", 0),
+        "vision_calls": vision_calls,
+        "code_only_retries": max(node_calls.count("node.code_generator") - vision_calls, 0),
+        "vision_seconds": vision_seconds,
+        "time_seconds": execution_time,
+        "peak_vram_gb": peak_vram_gb,
+        "error": error,
+        "trace": trace.to_dict(),
     }
 
-    total_time = 0
-
-    print(f"Running evaluation on {len(dataset)} charts...\n")
-
-    for i, item in enumerate(dataset):
-        print(f"--- Evaluating Item {i+1}/{len(dataset)}: {item['image_path']} ---")
-        
-        initial_state = {
-            "image_path": item["image_path"],
-            "user_query": item["query"],
-            "extracted_data": {},
-            "generated_code": "",
-            "execution_result": "",
-            "error_history": [],
-            "loop_count": 0,
-            "final_answer": ""
-        }
-
-        # Reset PyTorch memory stats for this specific run
-        if torch.cuda.is_available():
-            torch.cuda.reset_peak_memory_stats()
-
-        start_time = time.time()
-        
-        # Run the agent synchronously for the benchmark
-        final_state = app.invoke(initial_state)
-        
-        execution_time = time.time() - start_time
-        total_time += execution_time
-        
-        # Hardware Profiling
-        peak_vram_gb = 0
-        if torch.cuda.is_available():
-            peak_vram_gb = torch.cuda.max_memory_allocated() / (1024 ** 3)
-
-        actual_answer = final_state.get("final_answer", "").strip()
-        expected = item["expected_answer"].strip()
-        loops = final_state.get("loop_count", 0)
-        
-        results["total_loops_triggered"] += (loops - 1) if loops > 0 else 0
-
-        # Evaluation Logic
-        # (For a real project, you might use an LLM-as-a-judge here instead of strict string matching)
-        is_correct = expected in actual_answer
-        
-        if is_correct and loops <= 1:
-            print(f"✅ PASS (Baseline): Answered correctly on first attempt.")
-            results["baseline_correct"] += 1
-        elif is_correct and loops > 1:
-            print(f"🔄 PASS (Self-Corrected): Answered correctly after {loops - 1} correction loops.")
-            results["self_corrected_correct"] += 1
-        else:
-            print(f"❌ FAIL: Expected '{expected}', got '{actual_answer}'.")
-            results["failed"] += 1
-            
-        print(f"Time: {execution_time:.2f}s | Peak VRAM: {peak_vram_gb:.2f} GB\n")
 
-    # --- Final Report Generation ---
-    results["average_time_seconds"] = total_time / len(dataset)
-    baseline_accuracy = (results["baseline_correct"] / len(dataset)) * 100
-    final_accuracy = ((results["baseline_correct"] + results["self_corrected_correct"]) / len(dataset)) * 100
-    improvement = final_accuracy - baseline_accuracy
+def print_item(record: dict, position: str):
+    print(f"--- {position} Item {record['id']}: {record['image_path']} ---")
+    loops = record["loops"]
+    if record["error"]:
+        print(f"💥 ERROR: {record['error']}")
+    elif record["correct"] and loops <= 1:
+        print(f"✅ PASS (Baseline): Answered correctly on first attempt.")
+    elif record["correct"] and loops > 1:
+        print(f"🔄 PASS (Self-Corrected): Answered correctly after {loops - 1} correction loops.")
+    else:
+        print(f"❌ FAIL: Expected '{record['expected_answer']}', got '{record['final_answer']}'.")
+    print(f"Time: {record['time_seconds']:.2f}s | Peak VRAM: {record['peak_vram_gb']:.2f} GB\n")
+
+
+def run_shard(items: list, shard_index: int, num_shards: int, checkpoint_dir: str, app=None) -> int:
+    """
+    Evaluates this shard's share of the items, appending one JSON line per finished item
+    so a crash loses at most the item in flight. Returns how many items were run.
+    """
+    if app is None:
+        app = build_graph()
+    shard_path = os.path.join(checkpoint_dir, f"shard-{shard_index}-of-{num_shards}.jsonl")
+    shard_items = [item for i, item in enumerate(items) if i % num_shards == shard_index]
+
+    with open(shard_path, 'a') as checkpoint:
+        for n, item in enumerate(shard_items):
+            record = evaluate_item(app, item)
+            with _checkpoint_lock:
+                checkpoint.write(json.dumps(record) + "\n")
+                checkpoint.flush()
+                print_item(record, f"[shard {shard_index}] {n + 1}/{len(shard_items)}")
+    return len(shard_items)
+
+
+def _run_shard_process(dataset_items, shard_index, num_shards, checkpoint_dir):
+    get_engine().preload()
+    run_shard(dataset_items, shard_index, num_shards, checkpoint_dir)
+
+
+def summarize(records: list, run_wall_time: float, items_this_run: int) -> dict:
+    """Merges every shard's records into the final report."""
+    total = len(records)
+    baseline = sum(1 for r in records if r["correct"] and r["loops"] <= 1)
+    corrected = sum(1 for r in records if r["correct"] and r["loops"] > 1)
+    latency = latency_summary([r["time_seconds"] for r in records])
 
+    # A code-only retry saves one vision pass, valued at the mean measured vision call
+    vision_calls = sum(r.get("vision_calls", 0) for r in records)
+    code_only_retries = sum(r.get("code_only_retries", 0) for r in records)
+    mean_vision_s = sum(r.get("vision_seconds", 0.0) for r in records) / vision_calls if vision_calls else 0.0
+    return {
+        "total_tested": total,
+        "baseline_correct": baseline,        # Got it right on the very first try (0 loops)
+        "self_corrected_correct": corrected, # Got it right ONLY after looping and fixing an error
+        "failed": total - baseline - corrected,  # Never got it right, even after max retries
+        "errors": sum(1 for r in records if r["error"]),
+        "total_loops_triggered": sum(max(r["loops"] - 1, 0) for r in records),
+        "vision_calls": vision_calls,
+        "code_only_retries": code_only_retries,
+        "vision_calls_saved_per_item": (code_only_retries / total) if total else 0.0,
+        "vision_seconds_saved_per_item": (code_only_retries * mean_vision_s / total) if total else 0.0,
+        "baseline_accuracy": (baseline / total * 100) if total else 0.0,
+        "final_accuracy": ((baseline + corrected) / total * 100) if total else 0.0,
+        "average_time_seconds": latency["mean_s"],
+        "latency_p50_seconds": latency["p50_s"],
+        "latency_p90_seconds": latency["p90_s"],
+        "latency_p99_seconds": latency["p99_s"],
+        "peak_vram_gb": max((r["peak_vram_gb"] for r in records), default=0.0),
+        # Throughput only counts work done by this invocation (resumed items cost nothing)
+        "items_this_run": items_this_run,
+        "wall_time_seconds": run_wall_time,
+        "throughput_items_per_second": (items_this_run / run_wall_time) if run_wall_time > 0 else 0.0,
+    }
+
+
+def print_report(report: dict):
+    improvement = report["final_accuracy"] - report["baseline_accuracy"]
     print("=" * 50)
     print("BENCHMARK RESULTS")
     print("=" * 50)
-    print(f"Baseline Accuracy (No Loops):    {baseline_accuracy:.1f}%")
-    print(f"Final Accuracy (Self-Correcting): {final_accuracy:.1f}%")
+    print(f"Items Evaluated:                 {report['total_tested']} ({report['errors']} errors)")
+    print(f"Baseline Accuracy (No Loops):    {report['baseline_accuracy']:.1f}%")
+    print(f"Final Accuracy (Self-Correcting): {report['final_accuracy']:.1f}%")
     print(f"Net Accuracy Improvement:        +{improvement:.1f}%")
-    print(f"Total Correction Loops Fired:    {results['total_loops_triggered']}")
-    print(f"Average Inference Time:          {results['average_time_seconds']:.2f}s")
+    print(f"Total Correction Loops Fired:    {report['total_loops_triggered']}")
+    print(f"Code-Only Retries:               {report['code_only_retries']} "
+          f"({report['vision_calls_saved_per_item']:.2f} vision calls / "
+          f"{report['vision_seconds_saved_per_item']:.2f}s saved per item, {report['vision_calls']} vision calls made)")
+    print(f"Average Inference Time:          {report['average_time_seconds']:.2f}s")
+    print(f"Latency p50 / p90 / p99:         {report['latency_p50_seconds']:.2f}s / "
+          f"{report['latency_p90_seconds']:.2f}s / {report['latency_p99_seconds']:.2f}s")
+    print(f"Throughput (this run):           {report['throughput_items_per_second']:.3f} items/s "
+          f"({report['items_this_run']} items in {report['wall_time_seconds']:.1f}s)")
+    print(f"Peak VRAM:                       {report['peak_vram_gb']:.2f} GB")
+
+
+def print_trace_report(records: list):
+    """Aggregate per-node / per-call breakdown from every item's trace."""
+    spans = aggregate_spans(r["trace"] for r in records if r.get("trace"))
+    if not spans:
+        return
+    total_time = sum(r["time_seconds"] for r in records) or 1.0
+
+    print("-" * 50)
+    print("Per-Node Breakdown (all items)")
+    print(f"  {'span':<24} {'calls':>6} {'total_s':>9} {'mean_ms':>9} {'p99_ms':>9} {'share':>7}")
+    for name, stats in sorted(spans.items(), key=lambda kv: -kv[1]["total_s"]):
+        # Only top-level node spans partition the item time; nested spans would double count
+        share = f"{stats['total_s'] / total_time * 100:.1f}%" if name.startswith("node.") else ""
+        print(f"  {name:<24} {stats['calls']:>6} {stats['total_s']:>9.2f} {stats['mean_s'] * 1000:>9.1f} "
+              f"{stats['p99_s'] * 1000:>9.1f} {share:>7}")
+
+    llm = spans.get("llm.generate")
+    if llm:
+        attrs = llm["attrs"]
+        decode_s = attrs.get("decode_s", 0.0)
+        print(f"  LLM tokens: {attrs.get('prompt_tokens', 0):.0f} prompt / {attrs.get('completion_tokens', 0):.0f} generated | "
+              f"prefill {attrs.get('prefill_s', 0.0):.2f}s, decode {decode_s:.2f}s, queue {attrs.get('queue_s', 0.0):.2f}s | "
+              f"{(attrs.get('completion_tokens', 0) / decode_s) if decode_s else 0.0:.1f} tok/s")
+    images = spans.get("image.preprocess")
+    if images:
+        attrs = images["attrs"]
+        count = attrs.get("images", 0) or 1
+        print(f"  Images: {attrs.get('images', 0):.0f} prepared, {attrs.get('visual_tokens', 0) / count:.0f} visual tokens/image, "
+              f"{attrs.get('preprocess_s', 0.0) / count * 1000:.1f}ms preprocessing/image, {attrs.get('cached', 0):.0f} from cache")
+    history = spans.get("history.compact")
+    if history:
+        raw = history["attrs"].get("history_tokens_raw", 0)
+        compact = history["attrs"].get("history_tokens_compact", 0)
+        print(f"  Retry history tokens: {raw:.0f} raw -> {compact:.0f} in prompts "
+              f"({(1 - compact / raw) * 100 if raw else 0.0:.1f}% saved over {history['calls']} retries, "
+              f"{history['attrs'].get('history_dropped', 0):.0f} entries dropped)")
+    sandbox = spans.get("sandbox.run")
+    if sandbox:
+        print(f"  Sandbox time: {sandbox['attrs'].get('sandbox_s', 0.0):.3f}s over {sandbox['calls']} runs")
+
+
+def print_sandbox_report():
+    # Sandbox execution paths: in-process fast path vs. warm worker vs. fresh interpreter
+    sandbox = sandbox_stats()
+    print(f"Sandbox Fast-Path Hit Rate:      {sandbox['hit_rate'] * 100:.1f}% "
+          f"({sandbox['hits']} hits, {sandbox['fallbacks']} fallbacks, {sandbox['ineligible']} ineligible)")
+    for path in ("fast", "pool", "subprocess"):
+        if sandbox[path]["count"]:
+            print(f"  {path:<10} runs: {sandbox[path]['count']:<5} p50: {sandbox[path]['p50_ms']:.2f}ms  p99: {sandbox[path]['p99_ms']:.2f}ms")
+
+
+def run_benchmark(
+    dataset_path: str,
+    workers: int = 1,
+    mode: str = "thread",
+    checkpoint_dir: str = None,
+    resume: bool = True,
+    limit: int = None,
+) -> dict:
+    """
+    Evaluates the dataset across `workers` shards. Thread workers share one engine (and its
+    micro-batcher, if AGENT_BATCH_WINDOW_MS is set); process workers each load their own.
+    Finished items are streamed to per-shard JSONL checkpoints and skipped on restart.
+    """
+    print("Initializing Benchmark Suite...")
+
+    items = load_items(dataset_path, limit)
+
+    if checkpoint_dir is None:
+        dataset_name = os.path.splitext(os.path.basename(dataset_path))[0]
+        checkpoint_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", dataset_name)
+    if not resume and os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    completed = load_completed(checkpoint_dir)
+    pending = [item for item in items if item["id"] not in completed]
+    workers = max(1, min(workers, len(pending) or 1))
+
+    print(f"Running evaluation on {len(items)} charts "
+          f"({len(completed)} already checkpointed, {len(pending)} pending, {workers} {mode} workers)...\n")
+
+    # Pay the model load up front so it doesn't land in the first item's latency
+    if pending and mode == "thread":
+        print(f"Model loaded in {get_engine().preload():.1f}s\n")
+
+    start_time = time.time()
+    if pending:
+        if mode == "process":
+            ctx = multiprocessing.get_context("spawn")
+            processes = [
+                ctx.Process(target=_run_shard_process, args=(pending, k, workers, checkpoint_dir))
+                for k in range(workers)
+            ]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+        else:
+            app = build_graph()
+            threads = [
+                threading.Thread(target=run_shard, args=(pending, k, workers, checkpoint_dir, app))
+                for k in range(workers)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+    wall_time = time.time() - start_time
+
+    # --- Final Report Generation (merge every shard, including earlier runs) ---
+    merged = load_completed(checkpoint_dir)
+    records = [merged[item["id"]] for item in items if item["id"] in merged]
+    report = summarize(records, wall_time, len(pending))
+
+    report["spans"] = aggregate_spans(r["trace"] for r in records if r.get("trace"))
+
+    print_report(report)
+    print_trace_report(records)
+    if mode == "thread":
+        print_sandbox_report()
+    print("=" * 50)
+
+    # Raw spans plus a Chrome trace (chrome://tracing / Perfetto) of every item
+    write_traces([r["trace"] for r in records if r.get("trace")], checkpoint_dir)
+
+    with open(os.path.join(checkpoint_dir, "report.json"), 'w') as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def run_candidate_sweep(dataset_path: str, candidate_counts: list, checkpoint_dir: str = None, **kwargs) -> dict:
+    """
+    Runs the benchmark once per K (AGENT_CANDIDATES) and compares accuracy and end-to-end
+    latency. K=1 is the sequential retry loop; each K gets its own checkpoint directory.
+    """
+    if checkpoint_dir is None:
+        dataset_name = os.path.splitext(os.path.basename(dataset_path))[0]
+        checkpoint_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", dataset_name)
+
+    reports = {}
+    for k in candidate_counts:
+        os.environ["AGENT_CANDIDATES"] = str(k)
+        print(f"\n##### K = {k} candidate script(s) per coder call #####")
+        reports[k] = run_benchmark(dataset_path, checkpoint_dir=os.path.join(checkpoint_dir, f"k{k}"), **kwargs)
+
+    print("=" * 50)
+    print("CANDIDATES SWEEP (K=1 is the sequential retry loop)")
+    print(f"  {'K':>3} {'accuracy':>9} {'mean_s':>8} {'p90_s':>8} {'loops':>6} {'items/s':>8}")
+    for k, report in reports.items():
+        print(f"  {k:>3} {report['final_accuracy']:>8.1f}% {report['average_time_seconds']:>8.2f} "
+              f"{report['latency_p90_seconds']:>8.2f} {report['total_loops_triggered']:>6} "
+              f"{report['throughput_items_per_second']:>8.3f}")
+    print("=" * 50)
+    return reports
+
+
+def run_multi_query_benchmark(dataset_path: str, checkpoint_dir: str = None, limit: int = None, **kwargs) -> dict:
+    """
+    Answers the dataset with multi-query mode (core/multi_query.py: one shared extraction
+    per image, batched code generation) and compares time and vision calls per question
+    against the per-query graph on the same items.
+    """
+    if checkpoint_dir is None:
+        dataset_name = os.path.splitext(os.path.basename(dataset_path))[0]
+        checkpoint_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", dataset_name)
+
+    print("\n##### Per-query graph #####")
+    per_query = run_benchmark(dataset_path, checkpoint_dir=os.path.join(checkpoint_dir, "per_query"), limit=limit, **kwargs)
+
+    print("\n##### Multi-query mode #####")
+    items = load_items(dataset_path, limit)
+    groups = {}
+    for item in items:
+        groups.setdefault(item["image_path"], []).append(item)
+    print(f"Answering {len(items)} questions about {len(groups)} charts...\n")
+
+    app = build_graph()
+    records = []
+    start_time = time.time()
+    for n, (image_path, group) in enumerate(groups.items()):
+        started = time.time()
+        error = None
+        with trace_run(f"image-{n}") as trace:
+            try:
+                results = answer_queries(image_path, [item["query"] for item in group], app=app)
+            except Exception as e:
+                results, error = [{} for _ in group], f"{type(e).__name__}: {e}"
+        group_time = time.time() - started
+        node_calls = [s.name for s in trace.spans]
+        vision_calls = node_calls.count("node.vision_extractor")
+        vision_seconds = sum(s.duration_s for s in trace.spans if s.name == "node.vision_extractor")
+
+        # The image's cost is shared, so each question is charged an equal part of it
+        for k, (item, result) in enumerate(zip(group, results)):
+            actual_answer = result.get("final_answer", "").strip()
+            expected = item["expected_answer"].strip()
+            record = {
+                "id": item["id"],
+                "image_path": image_path,
+                "query": item["query"],
+                "expected_answer": expected,
+                "final_answer": actual_answer,
+                "correct": bool(actual_answer) and expected in actual_answer,
+                "loops": result.get("loops", 0),
+                "path": result.get("path", "failed"),
+                "vision_calls": vision_calls / len(group),
+                "code_only_retries": 0,
+                "vision_seconds": vision_seconds / len(group),
+                "time_seconds": group_time / len(group),
+                "peak_vram_gb": 0.0,
+                "error": error,
+                # One trace per image; attached once so span totals are not multiplied
+                "trace": trace.to_dict() if k == 0 else None,
+            }
+            records.append(record)
+            print_item(record, f"[image {n + 1}/{len(groups)}]")
+    multi_query = summarize(records, time.time() - start_time, len(records))
+    multi_query["answered_from_table"] = sum(1 for r in records if r["path"] == "table")
+    multi_query["re_extracted"] = sum(1 for r in records if r["path"] == "re-extracted")
+
+    multi_dir = os.path.join(checkpoint_dir, "multi_query")
+    os.makedirs(multi_dir, exist_ok=True)
+    with open(os.path.join(multi_dir, "records.jsonl"), 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    print_report(multi_query)
+    print_trace_report(records)
+
+    def per_question(report, key):
+        return report[key] / report["total_tested"] if report["total_tested"] else 0.0
+
     print("=" * 50)
+    print("MULTI-QUERY vs PER-QUERY GRAPH")
+    print(f"  {'mode':<12} {'accuracy':>9} {'s/question':>11} {'vision/question':>16}")
+    for name, report in (("per-query", per_query), ("multi-query", multi_query)):
+        print(f"  {name:<12} {report['final_accuracy']:>8.1f}% {report['average_time_seconds']:>11.2f} "
+              f"{per_question(report, 'vision_calls'):>16.2f}")
+    print(f"  {multi_query['answered_from_table']} questions answered from the shared table, "
+          f"{multi_query['re_extracted']} re-extracted")
+    print("=" * 50)
+
+    comparison = {"per_query": per_query, "multi_query": multi_query}
+    with open(os.path.join(multi_dir, "report.json"), 'w') as f:
+        json.dump(comparison, f, indent=4)
+    return comparison
+
 
 if __name__ == "__main__":
-    # Point this to your JSON dataset
-    run_benchmark("evals/test_dataset.json")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Evaluate the self-correcting agent on a chart QA dataset.")
+    parser.add_argument("--dataset", default="evals/test_dataset.json", help="JSON ledger of {image_path, query, expected_answer}, or a packed dataset directory.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of shards evaluated concurrently.")
+    parser.add_argument("--mode", choices=["thread", "process"], default="thread",
+                        help="thread: workers share one (batched) engine; process: one engine per worker.")
+    parser.add_argument("--checkpoint-dir", default=None, help="Where shard JSONL checkpoints and report.json go.")
+    parser.add_argument("--fresh", action="store_true", help="Discard existing checkpoints instead of resuming.")
+    parser.add_argument("--limit", type=int, default=None, help="Only evaluate the first N items.")
+    parser.add_argument("--candidates", default=None,
+                        help="Comma-separated K values (e.g. 1,2,4): compare K sampled scripts per coder call.")
+    parser.add_argument("--multi-query", action="store_true",
+                        help="Compare multi-query mode (one extraction per chart) against the per-query graph.")
+    args = parser.parse_args()
+
+    options = dict(workers=args.workers, mode=args.mode, resume=not args.fresh, limit=args.limit)
+    if args.multi_query:
+        run_multi_query_benchmark(args.dataset, args.checkpoint_dir, **options)
+    elif args.candidates:
+        run_candidate_sweep(args.dataset, [int(k) for k in args.candidates.split(",")], args.checkpoint_dir, **options)
+    else:
+        run_benchmark(args.dataset, checkpoint_dir=args.checkpoint_dir, **options)
@@ -1,9 +1,17 @@
+import argparse
 import os
 import json
 import random
-from datasets import load_dataset
+import sys
+
+# Add root to path so we can import the packed dataset utilities
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.packed import iter_arrow_rows, pack_rows
 
 def generate_benchmark_dataset(full: bool = False, num_samples: int = 20):
+    # Imported here so the rest of the evals package loads without `datasets`
+    from datasets import load_dataset
+
     print("Downloading ChartQA dataset from Hugging Face...")
     
     # Use the validation split because it's meant for testing and is smaller to download
@@ -60,5 +68,48 @@ def generate_benchmark_dataset(full: bool = False, num_samples: int = 20):
     print(f"   Images saved to: {output_dir}")
     print(f"   JSON saved to:   {json_path}")
 
+def generate_packed_dataset(
+    source: str,
+    output_dir: str,
+    image_column: str = "image",
+    query_column: str = "query",
+    answer_column: str = "label",
+    workers: int = None,
+    shard_size: int = 1000,
+    limit: int = None,
+):
+    """
+    Packs a local parquet/arrow copy of the dataset (e.g. the full ChartQA split) into
+    memory-mappable shards instead of one PNG per sample. Images are re-encoded on
+    `workers` processes; the benchmark accepts the output directory as --dataset.
+    """
+    def rows():
+        for n, row in enumerate(iter_arrow_rows(source, [image_column, query_column, answer_column])):
+            if limit is not None and n >= limit:
+                return
+            answer = row[answer_column]
+            yield {
+                "image": row[image_column],
+                "query": row[query_column],
+                # ChartQA stores answers in a list under the 'label' key (e.g., ["49"])
+                "expected_answer": answer[0] if isinstance(answer, list) else answer,
+            }
+
+    count = pack_rows(rows(), output_dir, image_column="image", workers=workers, shard_size=shard_size)
+    print(f"\nPacked {count} samples into {output_dir}")
+
+
 if __name__ == "__main__":
-    generate_benchmark_dataset(False, 100)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build the ChartQA evaluation set (PNG + JSON ledger, or packed shards).")
+    parser.add_argument("--pack", metavar="SOURCE", default=None,
+                        help="Local parquet file/directory or Arrow IPC file to pack instead of downloading PNGs.")
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(__file__), "packed", "chartqa"))
+    parser.add_argument("--workers", type=int, default=None, help="Image encoding processes (default: all cores).")
+    parser.add_argument("--shard-size", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.pack:
+        generate_packed_dataset(args.pack, args.output, workers=args.workers, shard_size=args.shard_size, limit=args.limit)
+    else:
+        generate_benchmark_dataset(False, 100)
\ No newline at end of file
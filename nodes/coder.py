@@ -1,7 +1,11 @@
+import os
 import re
-from core.state import AgentState
+from typing import List
+from core import tracing
+from core.history import render_history
 from core.state import AgentState
 from core.llm_engine import ai_engine
+from nodes.executor import MISSING_DATA_MARKER
 
 def extract_python_code(raw_text: str) -> str:
     """
@@ -12,35 +16,73 @@ def extract_python_code(raw_text: str) -> str:
         return code_match.group(1).strip()
     return raw_text.strip()
 
-def write_code_node(state: AgentState) -> dict:
-    # print(f"--- Running Local Coder Node ---")
-    
-    extracted_data = state.get("extracted_data", {})
-    if "extraction_error" in extracted_data:
-        return {"generated_code": f"FAILED_BEFORE_EXECUTION: {extracted_data['extraction_error']}"}
+def candidate_count() -> int:
+    """K scripts sampled per coder call (AGENT_CANDIDATES, default 1 = greedy, single script)."""
+    return max(int(os.getenv("AGENT_CANDIDATES", "1")), 1)
+
 
+def build_code_messages(extracted_data: dict, user_query: str, error_history: List[str], shared_table: bool = False) -> list:
+    """
+    The coder conversation for one query. With `shared_table` the data is the whole chart
+    (multi-query mode), so the script must say so when the value it needs is not there.
+    """
     base_prompt = f"""
     You are a Python data analyst. 
     Data: {extracted_data}
-    User Query: "{state['user_query']}"
+    User Query: "{user_query}"
     
     Write a Python script to calculate the exact answer. Hardcode the data dictionary.
     You MUST print the final answer starting with "SUCCESS: " followed by the result.
     Output ONLY valid Python code inside ```python blocks.
     """
+    if shared_table:
+        base_prompt += f"""If the data does not contain what the query needs, print "{MISSING_DATA_MARKER} " followed by the missing labels instead.
+    """
     
-    if state.get("error_history"):
+    if error_history:
         base_prompt += "\n\nCRITICAL WARNING: Your previous code crashed. Fix it based on these traces:"
-        for err in state.get("error_history"):
-            base_prompt += f"\n- Traceback: {err}"
+        base_prompt += render_history(error_history, "code_generator", "Traceback", ai_engine.count_tokens)
 
-    messages = [
+    return [
         {"role": "system", "content": "You write executable Python code without markdown filler."},
         {"role": "user", "content": [{"type": "text", "text": base_prompt}]}
     ]
+
+
+def write_code_node(state: AgentState) -> dict:
+    # print(f"--- Running Local Coder Node ---")
+    
+    extracted_data = state.get("extracted_data", {})
+    if "extraction_error" in extracted_data:
+        return {
+            "generated_code": f"FAILED_BEFORE_EXECUTION: {extracted_data['extraction_error']}",
+            "candidate_codes": [],
+        }
+
+    messages = build_code_messages(extracted_data, state["user_query"], state.get("error_history"))
     
     # Send to the SAME local 7B model 
-    raw_llm_response = ai_engine.generate_response(messages)
+    num_candidates = candidate_count()
+    if num_candidates > 1:
+        # K samples in one batched generate call; the executor races them in the sandbox
+        raw_responses = ai_engine.generate_candidates(
+            messages,
+            num_candidates,
+            temperature=float(os.getenv("AGENT_CANDIDATE_TEMPERATURE", "0.7")),
+            stop="python_block",
+        )
+    else:
+        raw_responses = [ai_engine.generate_response(messages, stop="python_block")]
     
-    clean_code = extract_python_code(raw_llm_response)
-    return {"generated_code": clean_code}
\ No newline at end of file
+    with tracing.span("parse.code"):
+        # Identical samples would only burn sandbox runs, so keep the distinct ones in order
+        candidates = list(dict.fromkeys(extract_python_code(raw) for raw in raw_responses))
+    update = {
+        "generated_code": candidates[0],
+        "candidate_codes": candidates if num_candidates > 1 else [],
+    }
+    if state.get("failure_type"):
+        # Routed straight back here after a code failure: this attempt counts towards the cap
+        update["loop_count"] = state.get("loop_count", 0) + 1
+        update["failure_type"] = ""
+    return update
\ No newline at end of file
@@ -1,67 +1,154 @@
-import subprocess
-import tempfile
+import contextvars
 import os
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List
+
+from core import tracing
 from core.state import AgentState
+from utils.sandbox import SandboxResult, run_code
+
+# --- Failure classes (drive the retry routing in core/graph.py) ---
+FAILURE_EXTRACTION = "extraction"  # the extractor returned unparsable data, nothing ran
+FAILURE_CODE = "code"              # the script crashed (SyntaxError, NameError, ...)
+FAILURE_LOGIC = "logic"            # the script ran but never printed SUCCESS:
+FAILURE_TIMEOUT = "timeout"        # the script was killed by the sandbox timeout
+
+# Failures the coder can fix on its own from the same extracted data
+CODE_ONLY_FAILURES = {FAILURE_CODE, FAILURE_TIMEOUT}
+
+# How a winner is picked among K candidate scripts: the first to succeed, or the majority answer
+SELECTION_MODES = ("first", "vote")
+
+# Printed by multi-query scripts when the shared table lacks the value a query needs
+MISSING_DATA_MARKER = "MISSING_DATA:"
 
 def execute_code_node(state: AgentState) -> dict:
     """
-    Takes the generated Python script, writes it to a temporary file, 
-    executes it in a separate process, and captures the output or errors.
+    Takes the generated Python script, runs it in an isolated sandbox worker
+    (see utils/sandbox.py), and captures the output or errors.
     """
-    
+
     generated_code = state.get("generated_code", "")
-    
+
     # 1. Edge Case Handling: Catch upstream failures
     if "FAILED_BEFORE_EXECUTION" in generated_code:
         return {
             "execution_result": "FAILED",
+            "failure_type": FAILURE_EXTRACTION,
             "error_history": [generated_code] # Append the upstream error to history
         }
 
-    # 2. Write the code to a secure, temporary file
-    # This file automatically deletes itself when closed or when the script ends
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as temp_script:
-        temp_script.write(generated_code)
-        temp_file_path = temp_script.name
-
-    try:
-        # 3. Execute the script in an isolated subprocess
-        # - capture_output=True grabs both print() statements (stdout) and crash logs (stderr)
-        # - timeout=10 prevents infinite loops from burning compute
-        result = subprocess.run(
-            ['python', temp_file_path], 
-            capture_output=True, 
-            text=True, 
-            timeout=10
-        )
-        
-        stdout = result.stdout.strip()
-        stderr = result.stderr.strip()
-        
-        # 4. Evaluate the result against our deterministic contract
-        if result.returncode == 0 and "SUCCESS:" in stdout:
-            return {
-                "execution_result": stdout,
-                "final_answer": stdout.replace("SUCCESS:", "").strip()
-            }
-        else:
-            # Code ran, but logic failed (e.g., missing the SUCCESS tag)
-            # Or the code crashed (returncode != 0)
-            error_msg = stderr if stderr else f"Logic Error: Script ran but did not output 'SUCCESS:'. Output was: {stdout}"
-            
-            # We wrap the error in a list [error_msg]. 
-            # Because we used operator.add in our State definition, LangGraph will append this!
-            return {
-                "execution_result": "FAILED",
-                "error_history": [error_msg] 
-            }
-
-    except subprocess.TimeoutExpired:
+    # K sampled candidates are raced against each other instead of run one by one
+    candidates = state.get("candidate_codes") or []
+    if len(candidates) > 1:
+        return execute_candidates(candidates)
+
+    # 2. Execute the script in an isolated process
+    # - stdout (print() statements) and stderr (crash logs) are both captured
+    # - timeout=10 prevents infinite loops from burning compute
+    return evaluate_result(_run(generated_code))
+
+
+def _run(code: str) -> SandboxResult:
+    with tracing.span("sandbox.run"):
+        result = run_code(code, timeout=10)
+        tracing.annotate(sandbox_s=result.duration_s, path=result.path, returncode=result.returncode)
+    return result
+
+
+def evaluate_result(result: SandboxResult) -> dict:
+    """Turns one sandbox run into the state update (answer, or classified failure)."""
+    if result.timed_out:
         return {
             "execution_result": "FAILED",
+            "failure_type": FAILURE_TIMEOUT,
             "error_history": ["TimeoutExpired: The generated code took longer than 10 seconds and was killed. Check for infinite loops."]
         }
-    finally:
-        # 5. Clean up the temporary file so we don't leak storage
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
\ No newline at end of file
+
+    stdout = result.stdout.strip()
+    stderr = result.stderr.strip()
+
+    # 3. Evaluate the result against our deterministic contract
+    if result.returncode == 0 and "SUCCESS:" in stdout:
+        return {
+            "execution_result": stdout,
+            "failure_type": "",
+            "final_answer": stdout.replace("SUCCESS:", "").strip()
+        }
+    else:
+        # Code ran, but logic failed (e.g., missing the SUCCESS tag)
+        # Or the code crashed (returncode != 0)
+        error_msg = stderr if stderr else f"Logic Error: Script ran but did not output 'SUCCESS:'. Output was: {stdout}"
+        failure_type = FAILURE_CODE if result.returncode != 0 else FAILURE_LOGIC
+
+        # We wrap the error in a list [error_msg].
+        # Because we used operator.add in our State definition, LangGraph will append this!
+        return {
+            "execution_result": "FAILED",
+            "failure_type": failure_type,
+            "error_history": [error_msg]
+        }
+
+
+def reports_missing_data(update: dict) -> bool:
+    """Whether a failed run points at absent data (a re-extraction can fix it) rather than a code bug."""
+    errors = update.get("error_history") or []
+    return any(MISSING_DATA_MARKER in error or "KeyError" in error for error in errors)
+
+
+def execute_many(codes: List[str]) -> List[dict]:
+    """Runs independent scripts (one per query) concurrently; one evaluated update per script."""
+    with ThreadPoolExecutor(max_workers=max(min(len(codes), os.cpu_count() or 4), 1), thread_name_prefix="query") as pool:
+        futures = [pool.submit(contextvars.copy_context().run, _run, code) for code in codes]
+        return [evaluate_result(future.result()) for future in futures]
+
+
+def execute_candidates(candidates: List[str]) -> dict:
+    """
+    Runs every candidate script concurrently in the sandbox. In "first" mode the first
+    script to print SUCCESS: wins; in "vote" mode all finish and the most common answer
+    wins (ties go to the earliest candidate). If none succeed, the first candidate's
+    failure is what gets recorded and routed.
+    """
+    selection = os.getenv("AGENT_CANDIDATE_SELECTION", "first")
+    if selection not in SELECTION_MODES:
+        raise ValueError(f"Unknown AGENT_CANDIDATE_SELECTION '{selection}'. Expected one of {SELECTION_MODES}.")
+
+    updates = [None] * len(candidates)
+    with tracing.span("sandbox.candidates", candidates=len(candidates), selection=selection) as record:
+        pool = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="candidate")
+        # Each thread gets a copy of the context so its sandbox.run span joins this trace
+        futures = {
+            pool.submit(contextvars.copy_context().run, _run, code): i
+            for i, code in enumerate(candidates)
+        }
+        pending = set(futures)
+        winner = None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=futures.get):
+                i = futures[future]
+                updates[i] = evaluate_result(future.result())
+                if selection == "first" and winner is None and "final_answer" in updates[i]:
+                    winner = i
+        # Losers still running are bounded by the sandbox timeout; don't wait for them
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        if selection == "vote":
+            answers = [(i, u["final_answer"]) for i, u in enumerate(updates) if u and "final_answer" in u]
+            if answers:
+                votes = Counter(answer for _, answer in answers)
+                best = max(votes.values())
+                winner = next(i for i, answer in answers if votes[answer] == best)
+
+        if record is not None:
+            record.attrs.update(
+                successes=sum(1 for u in updates if u and "final_answer" in u),
+                winner=-1 if winner is None else winner,
+            )
+
+    if winner is None:
+        return {**updates[0], "generated_code": candidates[0]}
+    # Keep the script that actually produced the answer as the run's generated code
+    return {**updates[winner], "generated_code": candidates[winner]}
@@ -1,6 +1,10 @@
 import json
+import os
 import re
 from typing import Dict, Any
+from core import tracing
+from core.history import render_history
+from core.stopping import first_json_object
 from core.state import AgentState
 from core.llm_engine import ai_engine
 
@@ -15,8 +19,9 @@ def clean_and_parse_json(raw_text: str) -> Dict[str, Any]:
     if json_match:
         json_string = json_match.group(1)
     else:
-        # If no backticks, assume the whole text is meant to be JSON
-        json_string = raw_text.strip()
+        # Early stopping cuts generation at the closing brace, so a ```json fence may never
+        # be closed; take the first balanced object, else assume the whole text is JSON
+        json_string = first_json_object(raw_text) or raw_text.strip()
         
     try:
         return json.loads(json_string)
@@ -25,6 +30,53 @@ def clean_and_parse_json(raw_text: str) -> Dict[str, Any]:
         return {"extraction_error": f"Failed to parse JSON. Raw output was: {raw_text}"}
 
 
+# Multi-query mode (core/multi_query.py): one extraction of the whole chart, shared by every question
+TABLE_PROMPT = """
+        You are an analytical data extraction agent.
+        Several questions will be asked about this chart, so extract ALL of its data, not just one value.
+
+        Your job is NOT to answer anything. Your job is ONLY to transcribe every labelled data point
+        (every series, category and value, including axis units) so Python scripts can answer any question later.
+
+        You MUST return the data STRICTLY as a valid JSON object matching this exact schema:
+        {
+            "reasoning": "What the chart shows: its title, axes, series and units.",
+            "extracted_data": {
+                "Series_or_Category_Label": Value,
+                "Another_Label": Value
+            }
+        }
+
+        Failure to put 'reasoning' first will cause system failure. Do not include markdown explanations outside the JSON.
+    """
+
+
+def _extraction_constraint():
+    # AGENT_CONSTRAINED_JSON=1 masks every token that would break the extraction schema
+    return "extraction" if os.getenv("AGENT_CONSTRAINED_JSON", "0") == "1" else None
+
+
+def _vision_messages(image_path: str, prompt: str) -> list:
+    # Qwen2.5-VL format for multimodal messages
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image", "image": image_path},
+                {"type": "text", "text": prompt},
+            ],
+        }
+    ]
+
+
+def extract_table(image_path: str) -> Dict[str, Any]:
+    """Full-chart extraction for multi-query mode: the parsed JSON (or an extraction_error)."""
+    raw_output = ai_engine.generate_response(_vision_messages(image_path, TABLE_PROMPT), stop="json",
+                                             constraint=_extraction_constraint())
+    with tracing.span("parse.json"):
+        return clean_and_parse_json(raw_output)
+
+
 def extract_data_node(state: AgentState) -> dict:
     
     base_prompt = f"""
@@ -47,25 +99,17 @@ def extract_data_node(state: AgentState) -> dict:
     
     if state.get("error_history"):
         base_prompt += "\n\nCRITICAL WARNING: Your previous extractions failed. Adjust your extraction based on these errors:"
-        for err in state.get("error_history"):
-            base_prompt += f"\n- Error: {err}"
+        base_prompt += render_history(state["error_history"], "vision_extractor", "Error", ai_engine.count_tokens)
 
-    # Qwen2.5-VL format for multimodal messages
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "image", "image": state["image_path"]},
-                {"type": "text", "text": base_prompt},
-            ],
-        }
-    ]
+    messages = _vision_messages(state["image_path"], base_prompt)
     
-    # Send to our local 7B model
-    raw_output = ai_engine.generate_response(messages)
+    # Send to our local 7B model; stop decoding as soon as the JSON object closes.
+    raw_output = ai_engine.generate_response(messages, stop="json", constraint=_extraction_constraint())
     
-    extracted_json = clean_and_parse_json(raw_output)
+    with tracing.span("parse.json"):
+        extracted_json = clean_and_parse_json(raw_output)
     return {
         "extracted_data": extracted_json,
-        "loop_count": state.get("loop_count", 0) + 1
+        "loop_count": state.get("loop_count", 0) + 1,
+        "failure_type": "",
     }
\ No newline at end of file
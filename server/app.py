@@ -0,0 +1,341 @@
+"""
+Async HTTP entrypoint for the agent.
+
+    POST /v1/jobs   multipart (image file + query) or JSON {"image_path", "query"}
+                    -> application/x-ndjson stream: queued, started, one event per graph
+                       node, then done (or error)
+    GET  /healthz   liveness plus in-flight / queued counts
+    GET  /metrics   admission counters, job latency percentiles and coalescing hit rates
+
+The graph is compiled once at startup. At most `max_inflight` graph runs execute at a time
+(each holds activations and KV cache on the one GPU); up to `max_queue` more wait for a
+slot, and anything beyond that is rejected immediately with 429 instead of piling up.
+A job identical to one already running (same image content, same normalized query) follows
+that run instead of taking a slot, and answered jobs are served from a TTL/LRU cache
+(see core/coalescing.py).
+
+    AGENT_BACKEND=stub python -m server.app --port 8080
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from aiohttp import web
+from dotenv import load_dotenv
+load_dotenv()
+
+# Add the root directory to the system path so we can import our core graph
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from core.coalescing import CLOSED, InflightRun, JobCoalescer, job_key
+from core.graph import build_graph
+from core.llm_engine import get_engine
+from core.state import initial_state
+from core.tracing import trace_run
+from utils.metrics import latency_summary
+
+
+def inflight_limit() -> int:
+    """
+    Concurrent graph runs: AGENT_SERVER_MAX_INFLIGHT, else the VRAM budget divided by the
+    per-job footprint (AGENT_SERVER_VRAM_BUDGET_GB / AGENT_SERVER_VRAM_PER_JOB_GB), else 2.
+    """
+    if os.getenv("AGENT_SERVER_MAX_INFLIGHT"):
+        return max(1, int(os.getenv("AGENT_SERVER_MAX_INFLIGHT")))
+    budget, per_job = os.getenv("AGENT_SERVER_VRAM_BUDGET_GB"), os.getenv("AGENT_SERVER_VRAM_PER_JOB_GB")
+    if budget and per_job:
+        return max(1, int(float(budget) // float(per_job)))
+    return 2
+
+
+class AgentServer:
+    """Admission control, the worker threads that run the graph, and the HTTP handlers."""
+
+    def __init__(self, max_inflight: int = 2, max_queue: int = 16, preload: bool = True):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.preload = preload
+        self.graph = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        # Graph runs are synchronous; each in-flight job gets its own worker thread
+        self._executor = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="graph")
+        self.inflight = 0
+        self.queued = 0
+        self.counters = {"accepted": 0, "rejected": 0, "completed": 0, "failed": 0, "disconnected": 0,
+                         "cached": 0, "coalesced": 0}
+        self.coalescer = JobCoalescer.from_env()
+        self._latencies = []
+        self._queue_waits = []
+        self._upload_dir = tempfile.mkdtemp(prefix="agent-uploads-")
+
+    # --- Lifecycle ---
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 1024 ** 2)
+        app.router.add_post("/v1/jobs", self.handle_job)
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.on_startup.append(self._startup)
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+    async def _startup(self, app):
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self.graph = build_graph()
+        if self.preload:
+            # Load the weights before accepting traffic so the first job doesn't pay for it
+            loop = asyncio.get_running_loop()
+            seconds = await loop.run_in_executor(self._executor, get_engine().preload)
+            print(f"Model loaded in {seconds:.1f}s")
+
+    async def _cleanup(self, app):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        shutil.rmtree(self._upload_dir, ignore_errors=True)
+
+    # --- Handlers ---
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "max_inflight": self.max_inflight,
+            "max_queue": self.max_queue,
+            "engine_loaded": get_engine().is_loaded,
+        })
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            **self.counters,
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "latency": latency_summary(self._latencies[-10000:]),
+            "queue_wait": latency_summary(self._queue_waits[-10000:]),
+            "coalescing": self.coalescer.stats() if self.coalescer is not None else None,
+        })
+
+    async def handle_job(self, request: web.Request) -> web.StreamResponse:
+        # Fast rejection: decide before reading the (possibly large) upload
+        if self.inflight + self.queued >= self.max_inflight + self.max_queue:
+            self.counters["rejected"] += 1
+            return web.json_response(
+                {"error": "Server is at capacity, retry later.", "inflight": self.inflight, "queued": self.queued},
+                status=429,
+                headers={"Retry-After": "1"},
+            )
+
+        self.queued += 1
+        waiting = True
+        job_id = uuid.uuid4().hex[:12]
+        image_path, owns_image, started = None, False, False
+        response, role, run = None, None, None
+        try:
+            image_path, query, owns_image = await self._read_job(request, job_id)
+            self.counters["accepted"] += 1
+            role, run = await self._acquire(job_id, image_path, query)
+            response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await response.prepare(request)
+            if role != "leader":
+                # Served without a slot: from the answer cache or by following the running twin
+                self.queued -= 1
+                waiting = False
+                await self._follow(response, job_id, role, run)
+                await response.write_eof()
+                return response
+            await self._send(response, {"event": "queued", "job_id": job_id, "position": self.queued})
+
+            enqueued_at = time.perf_counter()
+            async with self._slots:
+                self.queued -= 1
+                waiting = False
+                self.inflight += 1
+                try:
+                    self._queue_waits.append(time.perf_counter() - enqueued_at)
+                    if request.transport is None or request.transport.is_closing():
+                        # Left while queued: don't spend GPU time on a job nobody will read
+                        raise ConnectionResetError("Client disconnected while queued.")
+                    started = True
+                    await self._send(response, {"event": "started", "job_id": job_id})
+                    await self._run_job(response, job_id, image_path, query, owns_image, run)
+                finally:
+                    self.inflight -= 1
+            await response.write_eof()
+            return response
+        except ConnectionResetError:
+            # A job that already started is drained (and counted) in _run_job instead
+            if not started:
+                self.counters["disconnected"] += 1
+            return response if response is not None and response.prepared else web.Response(status=499)
+        finally:
+            if waiting:
+                self.queued -= 1
+            if role == "leader" and not started:
+                # A leader that never ran must still release anyone following it
+                run.publish({"event": "error", "job_id": job_id, "error": "The job this one was coalesced with was cancelled."})
+                self._finish(run, None)
+            # Once started, the worker thread owns (and removes) the uploaded file
+            if owns_image and not started and os.path.exists(image_path):
+                os.unlink(image_path)
+
+    async def _acquire(self, job_id: str, image_path: str, query: str):
+        """("leader", run) to execute the job; ("cached", result) or ("coalesced", run) otherwise."""
+        if self.coalescer is None:
+            return "leader", InflightRun(job_id)
+        try:
+            # Hashing reads the whole image, keep it off the event loop
+            key = await asyncio.get_running_loop().run_in_executor(None, job_key, image_path, query)
+        except (OSError, ValueError):
+            # Unreadable image: run uncoalesced and let the graph report the error
+            return "leader", InflightRun(job_id)
+        return self.coalescer.acquire(key)
+
+    async def _follow(self, response: web.StreamResponse, job_id: str, role: str, shared):
+        """Streams a cached result, or the events of the run this job was coalesced with."""
+        self.counters[role] += 1
+        if role == "cached":
+            await self._send(response, {"event": "done", "job_id": job_id, **shared, "cached": True})
+            return
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        shared.subscribe(lambda event: loop.call_soon_threadsafe(events.put_nowait, event))
+        await self._send(response, {"event": "started", "job_id": job_id, "coalesced": True})
+        while True:
+            event = await events.get()
+            if event is CLOSED:
+                break
+            extra = {"coalesced": True} if event["event"] in ("done", "error") else {}
+            await self._send(response, {**event, "job_id": job_id, **extra})
+
+    def _finish(self, run: InflightRun, result: Optional[dict]):
+        if self.coalescer is not None:
+            self.coalescer.complete(run, result)
+        else:
+            run.publish(CLOSED)
+
+    async def _read_job(self, request: web.Request, job_id: str):
+        """(image path, query, whether the file is ours to delete) from multipart or JSON."""
+        query, image_path, owns_image = None, None, False
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.name == "query":
+                    query = await part.text()
+                elif part.name == "image":
+                    suffix = os.path.splitext(part.filename or "")[1] or ".png"
+                    image_path = os.path.join(self._upload_dir, f"{job_id}{suffix}")
+                    owns_image = True
+                    with open(image_path, "wb") as f:
+                        while True:
+                            chunk = await part.read_chunk()
+                            if not chunk:
+                                break
+                            f.write(chunk)
+        else:
+            try:
+                body = await request.json()
+            except ValueError:
+                body = {}
+            query, image_path = body.get("query"), body.get("image_path")
+        if not query or not image_path:
+            if owns_image and os.path.exists(image_path):
+                os.unlink(image_path)
+            raise web.HTTPBadRequest(text=json.dumps({"error": "Both an image and a query are required."}),
+                                     content_type="application/json")
+        return image_path, query, owns_image
+
+    @staticmethod
+    async def _send(response: web.StreamResponse, event: dict):
+        await response.write((json.dumps(event, default=str) + "\n").encode("utf-8"))
+
+    async def _run_job(self, response: web.StreamResponse, job_id: str, image_path: str, query: str,
+                       owns_image: bool, run: InflightRun):
+        """Runs the graph on a worker thread and forwards its per-node events to the client."""
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        run.subscribe(lambda event: loop.call_soon_threadsafe(events.put_nowait, event))
+
+        started = time.perf_counter()
+        future = loop.run_in_executor(self._executor, self._execute, job_id, image_path, query, owns_image, run)
+
+        # Keep the slot until the graph finishes even if the client disconnects mid-stream:
+        # the GPU work is already committed, so the budget must still account for it
+        client_gone = False
+        while True:
+            event = await events.get()
+            if event is CLOSED:
+                break
+            if event["event"] == "done":
+                self._latencies.append(time.perf_counter() - started)
+                self.counters["completed"] += 1
+            elif event["event"] == "error":
+                self.counters["failed"] += 1
+            if not client_gone:
+                try:
+                    await self._send(response, event)
+                except ConnectionResetError:
+                    client_gone = True
+                    self.counters["disconnected"] += 1
+        await future
+
+    def _execute(self, job_id: str, image_path: str, query: str, owns_image: bool, run: InflightRun):
+        """Worker-thread side: streams the graph and publishes each node's update to `run`."""
+        emit = run.publish
+        started = time.perf_counter()
+        answer, loops = "", 0
+        result = None
+        try:
+            with trace_run(job_id) as trace:
+                for output in self.graph.stream(initial_state(image_path, query)):
+                    for node_name, update in output.items():
+                        answer = update.get("final_answer", answer)
+                        loops = update.get("loop_count", loops)
+                        emit({
+                            "event": "node",
+                            "job_id": job_id,
+                            "node": node_name,
+                            "elapsed_s": time.perf_counter() - started,
+                            "update": update,
+                        })
+            node_seconds = {}
+            for span in trace.spans:
+                if span.name.startswith("node."):
+                    node_seconds[span.name[5:]] = node_seconds.get(span.name[5:], 0.0) + span.duration_s
+            result = {
+                "final_answer": answer,
+                "loops": loops,
+                "time_seconds": time.perf_counter() - started,
+                "node_seconds": node_seconds,
+            }
+            emit({"event": "done", "job_id": job_id, **result})
+        except Exception as e:
+            emit({"event": "error", "job_id": job_id, "error": f"{type(e).__name__}: {e}"})
+        finally:
+            if owns_image and os.path.exists(image_path):
+                os.unlink(image_path)
+            # Only answered jobs are cached; followers get CLOSED either way
+            self._finish(run, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the self-correcting agent over HTTP.")
+    parser.add_argument("--host", default=os.getenv("AGENT_SERVER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("AGENT_SERVER_PORT", "8080")))
+    parser.add_argument("--max-inflight", type=int, default=None,
+                        help="Concurrent graph runs (default: AGENT_SERVER_MAX_INFLIGHT or the VRAM budget).")
+    parser.add_argument("--max-queue", type=int, default=int(os.getenv("AGENT_SERVER_MAX_QUEUE", "16")),
+                        help="Jobs allowed to wait for a slot before new ones get 429.")
+    parser.add_argument("--no-preload", action="store_true", help="Load the model on the first job instead of at startup.")
+    args = parser.parse_args()
+
+    server = AgentServer(
+        max_inflight=args.max_inflight or inflight_limit(),
+        max_queue=args.max_queue,
+        preload=not args.no_preload,
+    )
+    print(f"Serving on {args.host}:{args.port} (max in-flight {server.max_inflight}, queue depth {server.max_queue})")
+    web.run_app(server.build_app(), host=args.host, port=args.port, print=None)
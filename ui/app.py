@@ -1,6 +1,8 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import tempfile
 import os
+import threading
 from PIL import Image
 import sys
 
@@ -10,6 +12,7 @@ load_dotenv()
 # Add the root directory to the system path so we can import our core graph
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from core.graph import build_graph
+from core.llm_engine import stream_tokens
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -55,49 +58,67 @@ with col2:
                 "user_query": query,
                 "extracted_data": {},
                 "generated_code": "",
+                "candidate_codes": [],
                 "execution_result": "",
                 "error_history": [],
                 "loop_count": 0,
+                "failure_type": "",
                 "final_answer": ""
             }
 
             # 3. Stream the Output into the UI
             # st.status creates a great animated loading box that we can update dynamically
             with st.status("Initializing AI Engine...", expanded=True) as status:
+                # Live view of the tokens the model is generating for the current node
+                live = {"slot": st.empty(), "text": ""}
+                script_ctx = get_script_run_ctx()
+
+                def show_tokens(chunk: str):
+                    # Generation may run on the micro-batcher thread; attach it to this session
+                    add_script_run_ctx(threading.current_thread(), script_ctx)
+                    live["text"] += chunk
+                    live["slot"].code(live["text"][-2000:], language="markdown")
+
                 try:
-                    for output in app.stream(initial_state):
-                        for node_name, state_update in output.items():
+                    with stream_tokens(show_tokens):
+                        for output in app.stream(initial_state):
+                            # The node finished: swap the live view for its final rendering below
+                            live["slot"].empty()
+                            live["text"] = ""
+                            for node_name, state_update in output.items():
                             
-                            if node_name == "vision_extractor":
-                                loop_num = state_update.get('loop_count', 1)
-                                if loop_num > 1:
-                                    status.update(label=f"Self-Correction Loop Active (Attempt {loop_num})...")
-                                    st.warning(f"**Re-evaluating image based on previous failure...**")
-                                else:
-                                    status.update(label="Extracting Data from Image...")
+                                if node_name == "vision_extractor":
+                                    loop_num = state_update.get('loop_count', 1)
+                                    if loop_num > 1:
+                                        status.update(label=f"Self-Correction Loop Active (Attempt {loop_num})...")
+                                        st.warning(f"**Re-evaluating image based on previous failure...**")
+                                    else:
+                                        status.update(label="Extracting Data from Image...")
                                     
-                                st.markdown("##### Extracted JSON:")
-                                st.json(state_update.get("extracted_data", {}))
-                                st.divider()
-                                
-                            elif node_name == "code_generator":
-                                status.update(label="Writing Python Verification Script...")
-                                st.markdown("##### Generated Sandbox Code:")
-                                st.code(state_update.get("generated_code", ""), language="python")
-                                st.divider()
+                                    st.markdown("##### Extracted JSON:")
+                                    st.json(state_update.get("extracted_data", {}))
+                                    st.divider()
                                 
-                            elif node_name == "sandbox_executor":
-                                if "final_answer" in state_update:
-                                    # SUCCESS!
-                                    status.update(label="Execution Successful!", state="complete")
-                                    st.success(f"### Final Verified Answer:\n**{state_update['final_answer']}**")
-                                    st.balloons() # A little flair for the demo video
-                                elif "error_history" in state_update:
-                                    # FAILURE! Show the error and loop back
-                                    status.update(label="Execution Failed. Triggering Recalibration...")
-                                    latest_error = state_update['error_history'][-1]
-                                    st.error(f"**Sandbox Exception Caught:**\n\n```text\n{latest_error}\n```")
+                                elif node_name == "code_generator":
+                                    status.update(label="Writing Python Verification Script...")
+                                    st.markdown("##### Generated Sandbox Code:")
+                                    st.code(state_update.get("generated_code", ""), language="python")
                                     st.divider()
+                                
+                                elif node_name == "sandbox_executor":
+                                    if "final_answer" in state_update:
+                                        # SUCCESS!
+                                        status.update(label="Execution Successful!", state="complete")
+                                        st.success(f"### Final Verified Answer:\n**{state_update['final_answer']}**")
+                                        st.balloons() # A little flair for the demo video
+                                    elif "error_history" in state_update:
+                                        # FAILURE! Show the error and loop back
+                                        status.update(label="Execution Failed. Triggering Recalibration...")
+                                        latest_error = state_update['error_history'][-1]
+                                        st.error(f"**Sandbox Exception Caught:**\n\n```text\n{latest_error}\n```")
+                                        st.divider()
+                            # Open a fresh live view below this node's output for the next node
+                            live["slot"] = st.empty()
                                     
                 except Exception as e:
                     status.update(label="Critical Pipeline Failure", state="error")
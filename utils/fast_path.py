@@ -0,0 +1,194 @@
+"""
+In-process fast path for the simplest generated scripts.
+
+Most verification scripts are a hardcoded dict, a little arithmetic and a
+`print("SUCCESS: ...")`. If the AST only uses an allow-listed subset of Python (literals,
+arithmetic, comprehensions, a few builtins and `math`, no imports or attribute escapes),
+the script is run right here under a line-step budget instead of in a sandbox process.
+Anything outside the subset, and any script that raises, goes to the real sandbox.
+"""
+import ast
+import builtins
+import io
+import math
+import re
+import sys
+import time
+from typing import Optional
+
+SCRIPT_FILENAME = "generated_script.py"
+MAX_STEPS = 100_000          # traced line events per script
+MAX_SECONDS = 0.5            # wall budget, checked on every traced line
+MAX_OUTPUT_CHARS = 64 * 1024
+MAX_SEQUENCE_LEN = 1_000_000  # guards range() and sequence repetition
+MAX_POW_BITS = 10_000         # guards 10 ** 10 ** 10 style blow-ups
+
+SAFE_BUILTIN_NAMES = {
+    "abs", "all", "any", "bool", "dict", "enumerate", "filter", "float", "int", "isinstance",
+    "len", "list", "map", "max", "min", "print", "range", "reversed", "round", "set", "sorted",
+    "str", "sum", "tuple", "zip",
+    "Exception", "ArithmeticError", "IndexError", "KeyError", "TypeError", "ValueError", "ZeroDivisionError",
+}
+SAFE_MATH_NAMES = {
+    "ceil", "e", "exp", "fabs", "floor", "fsum", "inf", "isclose", "isfinite", "log", "log10",
+    "log2", "pi", "pow", "sqrt", "trunc",
+}
+SAFE_METHOD_NAMES = {
+    "append", "count", "endswith", "extend", "get", "index", "items", "join", "keys", "lower",
+    "replace", "sort", "split", "startswith", "strip", "upper", "values",
+}
+SAFE_NODE_TYPES = (
+    ast.Module, ast.Expr, ast.Assign, ast.AugAssign, ast.AnnAssign, ast.Pass, ast.Break, ast.Continue,
+    ast.If, ast.For, ast.While, ast.FunctionDef, ast.Return, ast.Lambda, ast.arguments, ast.arg,
+    ast.Try, ast.ExceptHandler, ast.Raise,
+    ast.Name, ast.Load, ast.Store, ast.Constant, ast.JoinedStr, ast.FormattedValue,
+    ast.List, ast.Tuple, ast.Dict, ast.Set, ast.Subscript, ast.Slice, ast.Starred,
+    ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.comprehension,
+    ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call, ast.keyword, ast.Attribute,
+    ast.Import, ast.alias,
+    ast.operator, ast.unaryop, ast.boolop, ast.cmpop, ast.expr_context,
+)
+
+
+class _StepBudgetExceeded(Exception):
+    pass
+
+
+def is_fast_path_eligible(code: str) -> bool:
+    """Static allow-list check; True means the script may run in-process."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+
+    for node in ast.walk(tree):
+        if not isinstance(node, SAFE_NODE_TYPES):
+            return False
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.LShift, ast.MatMult)):
+            return False
+        if isinstance(node, ast.Import):
+            if any(alias.name != "math" or alias.asname for alias in node.names):
+                return False
+        elif isinstance(node, ast.Name):
+            # No dunders (other than reading __name__ for the usual main guard)
+            if node.id.startswith("_") and node.id != "__name__":
+                return False
+        elif isinstance(node, ast.Attribute):
+            if isinstance(node.value, ast.Name) and node.value.id == "math":
+                if node.attr not in SAFE_MATH_NAMES:
+                    return False
+            elif node.attr not in SAFE_METHOD_NAMES:
+                return False
+        elif isinstance(node, ast.FunctionDef):
+            if node.decorator_list or node.name.startswith("_"):
+                return False
+        elif isinstance(node, ast.FormattedValue) and node.format_spec is not None:
+            # A huge width in a format spec is a cheap way to allocate a huge string
+            spec = "".join(
+                part.value for part in ast.walk(node.format_spec)
+                if isinstance(part, ast.Constant) and isinstance(part.value, str)
+            )
+            if re.search(r"\d{4,}", spec):
+                return False
+        elif isinstance(node, ast.ExceptHandler) and node.type is not None:
+            if not all(isinstance(n, ast.Name) and n.id in SAFE_BUILTIN_NAMES
+                       for n in ast.walk(node.type) if isinstance(n, ast.Name)):
+                return False
+    return True
+
+
+# --- Runtime guards injected into the script ---
+def _safe_pow(base, exponent):
+    if isinstance(base, int) and isinstance(exponent, int) and exponent > 0:
+        if abs(base) > 1 and exponent * max(abs(base).bit_length(), 1) > MAX_POW_BITS:
+            raise OverflowError("Exponent too large for the fast path.")
+    return base ** exponent
+
+
+def _safe_mult(left, right):
+    for sequence, count in ((left, right), (right, left)):
+        if isinstance(sequence, (str, bytes, list, tuple)) and isinstance(count, int):
+            if len(sequence) * count > MAX_SEQUENCE_LEN:
+                raise MemoryError("Sequence repetition too large for the fast path.")
+    return left * right
+
+
+def _safe_range(*args):
+    values = range(*args)
+    if len(values) > MAX_SEQUENCE_LEN:
+        raise MemoryError("range() too large for the fast path.")
+    return values
+
+
+class _GuardOperators(ast.NodeTransformer):
+    """Rewrites `a ** b` and `a * b` (including augmented forms) into guarded calls."""
+    _guards = {ast.Pow: "_safe_pow", ast.Mult: "_safe_mult"}
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        guard = self._guards.get(type(node.op))
+        if guard is None:
+            return node
+        return ast.copy_location(ast.Call(ast.Name(guard, ast.Load()), [node.left, node.right], []), node)
+
+    def visit_AugAssign(self, node):
+        self.generic_visit(node)
+        guard = self._guards.get(type(node.op))
+        if guard is None or not isinstance(node.target, ast.Name):
+            return node
+        value = ast.Call(ast.Name(guard, ast.Load()), [ast.Name(node.target.id, ast.Load()), node.value], [])
+        return ast.copy_location(ast.Assign([node.target], value), node)
+
+
+def run_fast_path(code: str, max_steps: int = MAX_STEPS) -> Optional[str]:
+    """
+    Runs an eligible script in-process and returns its stdout, or None if it raised,
+    exhausted its budget or printed too much (the caller then uses the real sandbox, which
+    also produces the genuine traceback for the self-correction prompt).
+    """
+    tree = _GuardOperators().visit(ast.parse(code))
+    ast.fix_missing_locations(tree)
+    compiled = compile(tree, SCRIPT_FILENAME, "exec")
+
+    output = io.StringIO()
+
+    def _print(*args, sep=" ", end="\n", **_):
+        output.write(sep.join(str(arg) for arg in args) + end)
+        if output.tell() > MAX_OUTPUT_CHARS:
+            raise _StepBudgetExceeded("Output limit exceeded.")
+
+    safe_builtins = {name: getattr(builtins, name) for name in SAFE_BUILTIN_NAMES}
+    # `import math` is the only import the allow-list lets through
+    safe_builtins.update({"print": _print, "range": _safe_range, "__import__": lambda name, *a, **k: math})
+    script_globals = {
+        "__name__": "__main__",
+        "__builtins__": safe_builtins,
+        "_safe_pow": _safe_pow,
+        "_safe_mult": _safe_mult,
+    }
+
+    steps = 0
+    deadline = time.perf_counter() + MAX_SECONDS
+
+    def _tracer(frame, event, arg):
+        if frame.f_code.co_filename != SCRIPT_FILENAME:
+            return None
+        return _line_counter
+
+    def _line_counter(frame, event, arg):
+        nonlocal steps
+        if event == "line":
+            steps += 1
+            if steps > max_steps or time.perf_counter() > deadline:
+                raise _StepBudgetExceeded("Step budget exceeded.")
+        return _line_counter
+
+    previous_trace = sys.gettrace()
+    sys.settrace(_tracer)
+    try:
+        exec(compiled, script_globals)
+    except Exception:
+        return None
+    finally:
+        sys.settrace(previous_trace)
+    return output.getvalue()
@@ -0,0 +1,33 @@
+import hashlib
+import os
+import threading
+from typing import Dict, Tuple
+
+# Rehashing a multi-MB chart on every loop would defeat the caches built on top of these
+# digests, so file hashes are memoized on (path, size, mtime).
+_file_digests: Dict[Tuple[str, int, int], str] = {}
+_lock = threading.Lock()
+
+
+def bytes_sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    """Content hash of a file, memoized until the file is modified."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        digest = _file_digests.get(memo_key)
+    if digest is not None:
+        return digest
+
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    with _lock:
+        _file_digests[memo_key] = digest
+    return digest
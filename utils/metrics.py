@@ -0,0 +1,24 @@
+import math
+from typing import Dict, Iterable, List
+
+
+def percentile(values: Iterable[float], pct: float) -> float:
+    """Nearest-rank percentile (pct in 0-100). Returns 0.0 for an empty sample."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def latency_summary(latencies_s: List[float], wall_time_s: float = 0.0) -> Dict[str, float]:
+    """Throughput and latency percentiles for a list of per-request latencies (in seconds)."""
+    count = len(latencies_s)
+    return {
+        "count": count,
+        "throughput_rps": (count / wall_time_s) if wall_time_s > 0 else 0.0,
+        "mean_s": (sum(latencies_s) / count) if count else 0.0,
+        "p50_s": percentile(latencies_s, 50),
+        "p90_s": percentile(latencies_s, 90),
+        "p99_s": percentile(latencies_s, 99),
+    }
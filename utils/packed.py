@@ -0,0 +1,243 @@
+"""
+Packed evaluation datasets: a few large files per shard instead of one PNG per sample.
+
+Layout of a packed dataset directory:
+    manifest.json              {"version": 1, "count": N, "shards": [{"name", "count"}, ...]}
+    shard-00000/images.bin     encoded images (PNG) back to back
+    shard-00000/index.bin      one fixed-size entry per image: offset, length, sha256
+    shard-00000/records.jsonl  one record per sample (query, expected_answer, ...)
+
+Readers memory-map images.bin and index.bin, iterate records.jsonl lazily, and address an
+image as `packed://<dataset dir>/<shard>#<row>`. The engine resolves those URIs (see
+core/image_preprocess.py), so the graph never needs the image on disk as a file.
+"""
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+PACKED_SCHEME = "packed://"
+MANIFEST = "manifest.json"
+_INDEX_ENTRY = struct.Struct("<QQ32s")  # offset, length, sha256 digest
+
+
+def is_packed_uri(value: Any) -> bool:
+    return isinstance(value, str) and value.startswith(PACKED_SCHEME)
+
+
+def is_packed_dataset(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+# --- Reading ---
+class PackedShard:
+    """One shard's images, memory-mapped; nothing is read until an image is requested."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._images_file = open(os.path.join(directory, "images.bin"), "rb")
+        self._index_file = open(os.path.join(directory, "index.bin"), "rb")
+        # mmap cannot map empty files
+        self._images = mmap.mmap(self._images_file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.fstat(self._images_file.fileno()).st_size else b""
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.fstat(self._index_file.fileno()).st_size else b""
+
+    def __len__(self) -> int:
+        return len(self._index) // _INDEX_ENTRY.size
+
+    def entry(self, row: int) -> Tuple[int, int, str]:
+        if not 0 <= row < len(self):
+            raise IndexError(f"Row {row} is out of range for packed shard {self.directory}.")
+        offset, length, digest = _INDEX_ENTRY.unpack_from(self._index, row * _INDEX_ENTRY.size)
+        return offset, length, digest.hex()
+
+    def image_bytes(self, row: int) -> bytes:
+        offset, length, _ = self.entry(row)
+        return self._images[offset:offset + length]
+
+    def records(self) -> Iterator[dict]:
+        with open(os.path.join(self.directory, "records.jsonl"), "r") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+_shards: Dict[str, PackedShard] = {}
+_shards_lock = threading.Lock()
+
+
+def _open_shard(directory: str) -> PackedShard:
+    directory = os.path.abspath(directory)
+    with _shards_lock:
+        shard = _shards.get(directory)
+        if shard is None:
+            shard = _shards[directory] = PackedShard(directory)
+        return shard
+
+
+def parse_packed_uri(uri: str) -> Tuple[str, int]:
+    """packed://<shard dir>#<row> -> (shard dir, row)."""
+    location, _, row = uri[len(PACKED_SCHEME):].rpartition("#")
+    if not location or not row.isdigit():
+        raise ValueError(f"Malformed packed image URI '{uri}'. Expected packed://<shard dir>#<row>.")
+    return location, int(row)
+
+
+def read_image_bytes(uri: str) -> bytes:
+    """The encoded image behind a packed:// URI."""
+    location, row = parse_packed_uri(uri)
+    return _open_shard(location).image_bytes(row)
+
+
+def packed_image_sha256(uri: str) -> str:
+    """Content hash recorded at pack time (no need to read or hash the image again)."""
+    location, row = parse_packed_uri(uri)
+    return _open_shard(location).entry(row)[2]
+
+
+class PackedDataset:
+    """Lazy, sequential view over a packed dataset; records are yielded as benchmark items."""
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, MANIFEST), "r") as f:
+            self.manifest = json.load(f)
+
+    def __len__(self) -> int:
+        return self.manifest["count"]
+
+    def __iter__(self) -> Iterator[dict]:
+        position = 0
+        for shard_info in self.manifest["shards"]:
+            shard_dir = os.path.join(self.root, shard_info["name"])
+            for row, record in enumerate(_open_shard(shard_dir).records()):
+                yield {
+                    "id": record.get("id", position),
+                    **record,
+                    "image_path": f"{PACKED_SCHEME}{shard_dir}#{row}",
+                }
+                position += 1
+
+
+# --- Writing ---
+def encode_image(value: Any) -> bytes:
+    """
+    PNG bytes for an image given as a PIL image, raw encoded bytes, or an Arrow/HF image
+    struct ({"bytes": ..., "path": ...}). Images are converted to RGB like the JSON ledger.
+    """
+    from PIL import Image
+
+    if isinstance(value, dict):
+        value = value.get("bytes") or value.get("path")
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(value))
+    elif isinstance(value, str):
+        image = Image.open(value)
+    else:
+        image = value
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class PackedWriter:
+    """Appends (encoded image, record) pairs into fixed-size shards and writes the manifest on close."""
+
+    def __init__(self, root: str, shard_size: int = 1000):
+        self.root = root
+        self.shard_size = shard_size
+        self.shards = []
+        self.count = 0
+        self._files = None
+        os.makedirs(root, exist_ok=True)
+
+    def _roll(self):
+        self._close_shard()
+        name = f"shard-{len(self.shards):05d}"
+        directory = os.path.join(self.root, name)
+        os.makedirs(directory, exist_ok=True)
+        self._files = {
+            "images": open(os.path.join(directory, "images.bin"), "wb"),
+            "index": open(os.path.join(directory, "index.bin"), "wb"),
+            "records": open(os.path.join(directory, "records.jsonl"), "w"),
+        }
+        self.shards.append({"name": name, "count": 0})
+
+    def _close_shard(self):
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+            self._files = None
+
+    def add(self, image_bytes: bytes, record: dict):
+        if self._files is None or self.shards[-1]["count"] >= self.shard_size:
+            self._roll()
+        offset = self._files["images"].tell()
+        self._files["images"].write(image_bytes)
+        self._files["index"].write(_INDEX_ENTRY.pack(offset, len(image_bytes), hashlib.sha256(image_bytes).digest()))
+        self._files["records"].write(json.dumps({"id": self.count, **record}) + "\n")
+        self.shards[-1]["count"] += 1
+        self.count += 1
+
+    def close(self):
+        self._close_shard()
+        # The manifest goes last: a dataset without one is an interrupted write
+        with open(os.path.join(self.root, MANIFEST), "w") as f:
+            json.dump({"version": 1, "count": self.count, "shards": self.shards}, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_arrow_rows(source: str, columns: Iterable[str], batch_size: int = 256) -> Iterator[dict]:
+    """Streams rows (as dicts) from a local parquet file/directory or Arrow IPC/feather file."""
+    import pyarrow.dataset as ds
+
+    fmt = "parquet" if source.endswith(".parquet") or os.path.isdir(source) else "ipc"
+    for batch in ds.dataset(source, format=fmt).to_batches(columns=list(columns), batch_size=batch_size):
+        yield from batch.to_pylist()
+
+
+def pack_rows(
+    rows: Iterable[dict],
+    root: str,
+    image_column: str = "image",
+    workers: Optional[int] = None,
+    shard_size: int = 1000,
+    chunk_size: int = 64,
+) -> int:
+    """
+    Packs rows into `root`, encoding the images on `workers` processes (records keep their
+    order). Every column other than the image one goes into the record. Returns the count.
+    """
+    def records_and_images():
+        for row in rows:
+            image = row.pop(image_column)
+            yield row, image
+
+    with PackedWriter(root, shard_size=shard_size) as writer, ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for record, image in records_and_images():
+            pending.append((record, image))
+            if len(pending) >= chunk_size * (workers or os.cpu_count() or 1):
+                _flush(pool, pending, writer, chunk_size)
+                pending = []
+        _flush(pool, pending, writer, chunk_size)
+        return writer.count
+
+
+def _flush(pool, pending, writer: PackedWriter, chunk_size: int):
+    # Bounded chunks keep memory flat on the full split while every worker stays busy
+    encoded = pool.map(encode_image, [image for _, image in pending], chunksize=max(1, chunk_size // 4))
+    for (record, _), image_bytes in zip(pending, encoded):
+        writer.add(image_bytes, record)
@@ -0,0 +1,334 @@
+import json
+import os
+import queue
+import select
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from utils.fast_path import is_fast_path_eligible, run_fast_path
+from utils.metrics import percentile
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+
+# Per-script limits applied inside every forked child
+DEFAULT_TIMEOUT_S = 10
+DEFAULT_CPU_SECONDS = 10
+DEFAULT_MEMORY_BYTES = 1024 ** 3
+DEFAULT_OUTPUT_BYTES = 1024 ** 2
+
+
+@dataclass
+class SandboxResult:
+    """What a generated script did: its output streams, exit status and how long it took."""
+    stdout: str
+    stderr: str
+    returncode: int
+    timed_out: bool = False
+    duration_s: float = 0.0
+    path: str = "pool"  # "fast" (in-process), "pool" (warm worker) or "subprocess"
+    cpu_s: float = 0.0
+    peak_rss_bytes: int = 0
+    output_bytes: int = 0
+    limit: str = ""     # the limit that stopped the script: "timeout", "cpu", "memory", "output" or ""
+
+    def usage(self) -> dict:
+        """What the run cost, as surfaced in the agent state and the benchmark."""
+        return {
+            "path": self.path,
+            "wall_s": self.duration_s,
+            "cpu_s": self.cpu_s,
+            "peak_rss_mb": self.peak_rss_bytes / 1024 ** 2,
+            "output_bytes": self.output_bytes,
+            "limit": self.limit,
+        }
+
+
+@dataclass
+class SandboxLimits:
+    """Per-script caps: wall clock, CPU time, address space and captured output (None = unlimited)."""
+    timeout_s: float = DEFAULT_TIMEOUT_S
+    cpu_seconds: Optional[int] = DEFAULT_CPU_SECONDS
+    memory_bytes: Optional[int] = DEFAULT_MEMORY_BYTES
+    output_bytes: Optional[int] = DEFAULT_OUTPUT_BYTES
+
+    @classmethod
+    def from_env(cls, timeout_s: float = DEFAULT_TIMEOUT_S) -> "SandboxLimits":
+        """AGENT_SANDBOX_CPU_S, AGENT_SANDBOX_MEMORY_MB and AGENT_SANDBOX_OUTPUT_KB (0 disables each)."""
+        cpu = int(os.getenv("AGENT_SANDBOX_CPU_S", str(DEFAULT_CPU_SECONDS)))
+        memory_mb = int(os.getenv("AGENT_SANDBOX_MEMORY_MB", str(DEFAULT_MEMORY_BYTES // 1024 ** 2)))
+        output_kb = int(os.getenv("AGENT_SANDBOX_OUTPUT_KB", str(DEFAULT_OUTPUT_BYTES // 1024)))
+        return cls(
+            timeout_s=timeout_s,
+            cpu_seconds=cpu or None,
+            memory_bytes=memory_mb * 1024 ** 2 or None,
+            output_bytes=output_kb * 1024 or None,
+        )
+
+
+class SandboxWorkerError(RuntimeError):
+    """The worker process died or stopped answering (not the script failing)."""
+
+
+class _SandboxWorker:
+    """Handle on one pre-started worker process and its protocol pipes."""
+
+    def __init__(self):
+        self.runs = 0
+        self.proc = subprocess.Popen(
+            [sys.executable, WORKER_PATH],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        # Block until the worker has finished its imports and is ready for jobs
+        self._read(timeout=30)
+
+    def run(self, job: dict, timeout: float) -> dict:
+        payload = json.dumps(job).encode("utf-8")
+        try:
+            self.proc.stdin.write(struct.pack(">I", len(payload)) + payload)
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise SandboxWorkerError(f"Sandbox worker is gone: {e}")
+        self.runs += 1
+        return self._read(timeout)
+
+    def _read(self, timeout: float) -> dict:
+        header = self._read_exact(4, timeout)
+        (length,) = struct.unpack(">I", header)
+        return json.loads(self._read_exact(length, timeout))
+
+    def _read_exact(self, size: int, timeout: float) -> bytes:
+        fd = self.proc.stdout.fileno()
+        deadline = time.perf_counter() + timeout
+        data = b""
+        while len(data) < size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise SandboxWorkerError("Sandbox worker stopped responding.")
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                raise SandboxWorkerError("Sandbox worker exited unexpectedly.")
+            data += chunk
+        return data
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def close(self):
+        if self.alive():
+            self.proc.kill()
+        self.proc.wait()
+        for stream in (self.proc.stdin, self.proc.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class SandboxPool:
+    """
+    Pool of warm, pre-started sandbox workers.
+
+    Each worker is a separate interpreter that already has the common modules imported; it
+    forks a fresh, rlimited child per script, so a run costs a fork instead of an interpreter
+    start and scripts stay isolated from each other. Workers are recycled after
+    `max_runs_per_worker` scripts or as soon as they crash or hang. Concurrent graph runs
+    each borrow their own worker, so scripts execute in parallel.
+    """
+
+    def __init__(self, size: int = 4, max_runs_per_worker: int = 100):
+        self.size = max(1, size)
+        self.max_runs_per_worker = max_runs_per_worker
+        self._idle: "queue.Queue[_SandboxWorker]" = queue.Queue()
+        self._closed = False
+        for _ in range(self.size):
+            self._idle.put(_SandboxWorker())
+
+    def run(
+        self,
+        code: str,
+        timeout: float = DEFAULT_TIMEOUT_S,
+        cpu_seconds: Optional[int] = DEFAULT_CPU_SECONDS,
+        memory_bytes: Optional[int] = DEFAULT_MEMORY_BYTES,
+        output_bytes: Optional[int] = DEFAULT_OUTPUT_BYTES,
+    ) -> SandboxResult:
+        if self._closed:
+            raise RuntimeError("SandboxPool is closed.")
+        worker = self._idle.get()
+        try:
+            job = {"code": code, "timeout": timeout, "cpu_seconds": cpu_seconds, "memory_bytes": memory_bytes,
+                   "output_bytes": output_bytes}
+            # Give the worker some slack beyond the script's own deadline to kill and reap it
+            reply = worker.run(job, timeout=timeout + 5)
+        except SandboxWorkerError:
+            worker.close()
+            worker = _SandboxWorker()
+            raise
+        finally:
+            if worker.runs >= self.max_runs_per_worker or not worker.alive():
+                worker.close()
+                worker = _SandboxWorker()
+            self._idle.put(worker)
+        return SandboxResult(**reply)
+
+    def close(self):
+        self._closed = True
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+_pool: Optional[SandboxPool] = None
+_pool_lock = threading.Lock()
+
+
+def pool_enabled() -> bool:
+    # Forking workers needs POSIX; AGENT_SANDBOX_POOL=0 restores one interpreter per script
+    return hasattr(os, "fork") and os.getenv("AGENT_SANDBOX_POOL", "1") != "0"
+
+
+def get_sandbox_pool() -> SandboxPool:
+    """Process-wide pool, started on first use and sized by AGENT_SANDBOX_WORKERS."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool(
+                size=int(os.getenv("AGENT_SANDBOX_WORKERS", "4")),
+                max_runs_per_worker=int(os.getenv("AGENT_SANDBOX_MAX_RUNS", "100")),
+            )
+        return _pool
+
+
+# --- Execution-path accounting (fast-path hit rate and per-path latency) ---
+_stats_lock = threading.Lock()
+_path_latencies = {"fast": deque(maxlen=10000), "pool": deque(maxlen=10000), "subprocess": deque(maxlen=10000)}
+_fast_path_counts = {"eligible": 0, "hits": 0, "fallbacks": 0, "ineligible": 0}
+
+
+def fast_path_enabled() -> bool:
+    return os.getenv("AGENT_FAST_PATH", "1") != "0"
+
+
+def sandbox_stats() -> dict:
+    """Fast-path hit rate plus count/mean/p50/p99 latency (ms) for each execution path."""
+    with _stats_lock:
+        counts = dict(_fast_path_counts)
+        latencies = {path: list(values) for path, values in _path_latencies.items()}
+    total = counts["eligible"] + counts["ineligible"]
+    stats = {**counts, "hit_rate": (counts["hits"] / total) if total else 0.0}
+    for path, values in latencies.items():
+        stats[path] = {
+            "count": len(values),
+            "mean_ms": (sum(values) / len(values) * 1000) if values else 0.0,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+    return stats
+
+
+def _record(result: SandboxResult) -> SandboxResult:
+    with _stats_lock:
+        _path_latencies[result.path].append(result.duration_s)
+    return result
+
+
+def run_code(
+    code: str,
+    timeout: float = DEFAULT_TIMEOUT_S,
+    allow_fast_path: bool = True,
+    limits: Optional[SandboxLimits] = None,
+) -> SandboxResult:
+    """
+    Executes a generated script in isolation and captures what it printed and what it cost.
+    `limits` defaults to SandboxLimits.from_env() with `timeout` as the wall-clock cap.
+    """
+    limits = limits or SandboxLimits.from_env(timeout)
+    if allow_fast_path and fast_path_enabled():
+        start = time.perf_counter()
+        eligible = is_fast_path_eligible(code)
+        stdout = run_fast_path(code) if eligible else None
+        with _stats_lock:
+            _fast_path_counts["eligible" if eligible else "ineligible"] += 1
+            if eligible:
+                _fast_path_counts["hits" if stdout is not None else "fallbacks"] += 1
+        if stdout is not None:
+            # Pure arithmetic evaluated inline on this thread: its wall time is its CPU time
+            duration_s = time.perf_counter() - start
+            return _record(SandboxResult(stdout, "", 0, duration_s=duration_s, path="fast", cpu_s=duration_s,
+                                         output_bytes=len(stdout.encode("utf-8"))))
+
+    if pool_enabled():
+        try:
+            return _record(get_sandbox_pool().run(
+                code,
+                timeout=limits.timeout_s,
+                cpu_seconds=limits.cpu_seconds,
+                memory_bytes=limits.memory_bytes,
+                output_bytes=limits.output_bytes,
+            ))
+        except SandboxWorkerError:
+            pass  # The worker was replaced; run this script the slow way rather than failing it
+    return _record(_run_in_subprocess(code, limits))
+
+
+def _subprocess_limits(limits: SandboxLimits):
+    """preexec_fn applying the CPU/address-space rlimits in the child (POSIX only)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    def apply():
+        if limits.cpu_seconds:
+            resource.setrlimit(resource.RLIMIT_CPU, (limits.cpu_seconds, limits.cpu_seconds + 1))
+        if limits.memory_bytes:
+            resource.setrlimit(resource.RLIMIT_AS, (limits.memory_bytes, limits.memory_bytes))
+    return apply
+
+
+def _run_in_subprocess(code: str, limits: SandboxLimits) -> SandboxResult:
+    """
+    Fallback: write the script to a temporary file and spawn a fresh interpreter. The rlimits
+    still apply, but subprocess reaps the child itself, so CPU time and peak RSS are not
+    measured and the output cap is enforced on what was captured.
+    """
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as temp_script:
+        temp_script.write(code)
+        temp_file_path = temp_script.name
+
+    start = time.perf_counter()
+    try:
+        result = subprocess.run(
+            [sys.executable, temp_file_path],
+            capture_output=True,
+            text=True,
+            timeout=limits.timeout_s,
+            preexec_fn=_subprocess_limits(limits),
+        )
+        output_bytes = len(result.stdout.encode("utf-8")) + len(result.stderr.encode("utf-8"))
+        if limits.output_bytes and output_bytes > limits.output_bytes:
+            return SandboxResult(result.stdout[:limits.output_bytes], result.stderr[:limits.output_bytes], -9,
+                                 duration_s=time.perf_counter() - start, path="subprocess",
+                                 output_bytes=output_bytes, limit="output")
+        limit = "memory" if "MemoryError" in result.stderr else ""
+        # RLIMIT_CPU sends SIGXCPU at the soft limit and SIGKILL at the hard one (POSIX only)
+        if limits.cpu_seconds and result.returncode in (-getattr(signal, "SIGXCPU", 24), -9):
+            limit = "cpu"
+        return SandboxResult(result.stdout, result.stderr, result.returncode,
+                             duration_s=time.perf_counter() - start, path="subprocess", output_bytes=output_bytes,
+                             limit=limit)
+    except subprocess.TimeoutExpired:
+        return SandboxResult("", "", -9, timed_out=True, duration_s=time.perf_counter() - start, path="subprocess",
+                             limit="timeout")
+    finally:
+        # Clean up the temporary file so we don't leak storage
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
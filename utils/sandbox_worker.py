@@ -0,0 +1,193 @@
+"""
+Long-lived sandbox worker. Started by utils.sandbox.SandboxPool, it receives scripts over
+its stdin pipe, runs each one in a freshly forked child (so no state leaks between scripts),
+and replies with the captured stdout/stderr/returncode on its original stdout, plus what the
+child cost (CPU time and peak RSS from wait4) and which limit, if any, stopped it.
+
+Messages in both directions are a 4-byte big-endian length followed by a JSON payload.
+This file is executed as a script and must not import anything from the repository.
+"""
+import json
+import linecache
+import os
+import resource
+import select
+import signal
+import struct
+import sys
+import time
+import traceback
+
+# Modules generated scripts commonly use. Importing them once here means every forked
+# child starts with them already loaded.
+PREIMPORTS = ["math", "statistics", "json", "re", "collections", "itertools", "functools", "decimal", "fractions", "datetime"]
+
+SCRIPT_FILENAME = "generated_script.py"
+
+
+def read_message(stream):
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    (length,) = struct.unpack(">I", header)
+    payload = b""
+    while len(payload) < length:
+        chunk = stream.read(length - len(payload))
+        if not chunk:
+            return None
+        payload += chunk
+    return json.loads(payload)
+
+
+def write_message(stream, message):
+    payload = json.dumps(message).encode("utf-8")
+    stream.write(struct.pack(">I", len(payload)) + payload)
+    stream.flush()
+
+
+def _apply_limits(cpu_seconds, memory_bytes):
+    if cpu_seconds:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    if memory_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+
+def _run_child(code, out_w, err_w, protocol_fds, cpu_seconds, memory_bytes):
+    """Body of the forked child. Never returns."""
+    exit_code = 0
+    try:
+        for fd in protocol_fds:
+            os.close(fd)
+        os.dup2(out_w, 1)
+        os.dup2(err_w, 2)
+        sys.stdout = open(1, "w", closefd=False)
+        sys.stderr = open(2, "w", closefd=False)
+        _apply_limits(cpu_seconds, memory_bytes)
+
+        # Register the source so tracebacks show the offending lines, like running a file would
+        linecache.cache[SCRIPT_FILENAME] = (len(code), None, code.splitlines(True), SCRIPT_FILENAME)
+        compiled = compile(code, SCRIPT_FILENAME, "exec")
+        exec(compiled, {"__name__": "__main__", "__file__": SCRIPT_FILENAME, "__builtins__": __builtins__})
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        # Drop this function's frame so the traceback starts at the script itself
+        etype, value, tb = sys.exc_info()
+        traceback.print_exception(etype, value, tb.tb_next if tb is not None else None)
+        exit_code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+def _limit_hit(status, rusage, stderr, cpu_seconds, output_exceeded, timed_out):
+    """Which resource limit ended the script: "timeout", "output", "cpu", "memory" or ""."""
+    if timed_out:
+        return "timeout"
+    if output_exceeded:
+        return "output"
+    signal_number = os.WTERMSIG(status) if os.WIFSIGNALED(status) else 0
+    if cpu_seconds and (signal_number == signal.SIGXCPU or
+                        (signal_number == signal.SIGKILL and rusage.ru_utime + rusage.ru_stime >= cpu_seconds)):
+        return "cpu"
+    # RLIMIT_AS surfaces as a MemoryError (or a failed allocation inside an extension)
+    if "MemoryError" in stderr:
+        return "memory"
+    return ""
+
+
+def run_job(job, protocol_fds):
+    timeout = job.get("timeout", 10)
+    output_bytes = job.get("output_bytes")
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    start = time.perf_counter()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(out_r)
+        os.close(err_r)
+        _run_child(job["code"], out_w, err_w, protocol_fds, job.get("cpu_seconds"), job.get("memory_bytes"))
+
+    os.close(out_w)
+    os.close(err_w)
+
+    # Drain both pipes until the child closes them, the wall-clock deadline passes or the
+    # combined output goes over its cap
+    buffers = {out_r: bytearray(), err_r: bytearray()}
+    open_fds = [out_r, err_r]
+    deadline = start + timeout
+    timed_out = output_exceeded = False
+    while open_fds and not output_exceeded:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            timed_out = True
+            break
+        ready, _, _ = select.select(open_fds, [], [], remaining)
+        for fd in ready:
+            chunk = os.read(fd, 65536)
+            if chunk:
+                buffers[fd].extend(chunk)
+                if output_bytes and len(buffers[out_r]) + len(buffers[err_r]) > output_bytes:
+                    output_exceeded = True
+                    break
+            else:
+                open_fds.remove(fd)
+
+    if timed_out or output_exceeded:
+        os.kill(pid, signal.SIGKILL)
+    _, status, rusage = os.wait4(pid, 0)
+    os.close(out_r)
+    os.close(err_r)
+    for fd in (out_r, err_r):
+        if output_bytes:
+            del buffers[fd][output_bytes:]
+
+    stderr = buffers[err_r].decode("utf-8", errors="replace")
+    return {
+        "stdout": buffers[out_r].decode("utf-8", errors="replace"),
+        "stderr": stderr,
+        "returncode": os.waitstatus_to_exitcode(status),
+        "timed_out": timed_out,
+        "duration_s": time.perf_counter() - start,
+        "cpu_s": rusage.ru_utime + rusage.ru_stime,
+        # ru_maxrss is in KiB on Linux (bytes on macOS)
+        "peak_rss_bytes": rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "output_bytes": len(buffers[out_r]) + len(buffers[err_r]),
+        "limit": _limit_hit(status, rusage, stderr, job.get("cpu_seconds"), output_exceeded, timed_out),
+    }
+
+
+def main():
+    # Keep private copies of the protocol pipes and point fds 0/1 at /dev/null, so neither
+    # stray prints from this process nor forked children can corrupt the protocol stream.
+    protocol_in = os.fdopen(os.dup(0), "rb", buffering=0)
+    protocol_out = os.fdopen(os.dup(1), "wb", buffering=0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    for module in PREIMPORTS:
+        __import__(module)
+
+    protocol_fds = [protocol_in.fileno(), protocol_out.fileno()]
+    write_message(protocol_out, {"ready": True})
+    while True:
+        job = read_message(protocol_in)
+        if job is None:
+            return
+        write_message(protocol_out, run_job(job, protocol_fds))
+
+
+if __name__ == "__main__":
+    main()